@@ -5,7 +5,7 @@ import time
 
 import pytest
 
-from tuxeatpi_common.cli import main_cli, set_daemon_class, cli
+from tuxeatpi_common.cli import main_cli, set_daemon_class, cli, compile_dialogs_cli
 from tuxeatpi_common.daemon import TepBaseDaemon
 from tuxeatpi_common.initializer import Initializer
 
@@ -43,3 +43,12 @@ class TestCli(object):
         with pytest.raises(SystemExit) as exp:
             cli(FakeDaemon)
             assert str(exp) == "Stop main loop"
+
+    def test_compile_dialogs(self, tmpdir):
+        runner = CliRunner()
+        bundle_path = str(tmpdir.join("dialogs.bundle"))
+        result = runner.invoke(compile_dialogs_cli, ['-D', 'tests/cli_test/dialogs',
+                                                     '-o', bundle_path])
+        assert result.exit_code == 0
+        assert "3 dialogs and 3 sentences compiled" in result.output
+        assert os.path.isfile(bundle_path)
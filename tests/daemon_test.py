@@ -135,3 +135,42 @@ class TestDaemon(object):
 
         # TODO capture logging output
         self.fake_daemon.reload()
+
+
+class FakeSingleLoopDaemon(FakeDaemon):
+
+    def __init__(self, name, workdir, intent_folder, dialog_folder, logging_level=logging.INFO):
+        TepBaseDaemon.__init__(self, name, workdir, intent_folder, dialog_folder, logging_level,
+                               single_loop=True)
+        self.args1 = None
+        self.started = False
+        self.help_arg = None
+
+
+class TestSingleLoopDaemon(object):
+
+    def test_single_loop_daemon(self):
+        intents_folder = "tests/daemon_test/intents"
+        dialogs_folder = "tests/daemon_test/dialogs"
+        workdir = "tests/daemon_test/workdir"
+        fake_daemon = FakeSingleLoopDaemon("fake_single_loop_daemon", workdir,
+                                           intents_folder, dialogs_folder)
+        fake_daemon.settings.save({"language": "en_US", "nlu_engine": "nlu_test"}, "global")
+        fake_daemon.settings.save({"param1": "value1"})
+        thread = threading.Thread(target=fake_daemon.start)
+        thread.start()
+        time.sleep(3)
+        # No subtasker thread
+        assert not fake_daemon._tasks_thread.is_alive()
+        assert fake_daemon.started == "OK"
+        assert fake_daemon._tasks_thread.heartbeat.runs >= 1
+        assert "fake_single_loop_daemon" in fake_daemon.registry.read()
+        # Settings changes are watched from the daemon event loop
+        fake_daemon.settings.save({"param1": "value2"})
+        time.sleep(1)
+        assert fake_daemon.args1 == "value2"
+
+        fake_daemon.shutdown()
+        thread.join(5)
+        assert not thread.is_alive()
+        fake_daemon.settings.delete()
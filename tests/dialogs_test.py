@@ -1,3 +1,4 @@
+import asyncio
 import sys
 import os
 import time
@@ -19,7 +20,10 @@ class TestDialog(object):
         loaded_dialogs = {'en_US': {'render_test': {'This is a rendering test {{ test }}'},
                                     'empty': set(),
                                     'test': {'This is a test', 'This is an other test'}}}
-        assert dialogs_test._dialogs == loaded_dialogs
+        assert {lang: {key: set(sentences) for key, sentences in dialogs.items()}
+                for lang, dialogs in dialogs_test._dialogs.items()} == loaded_dialogs
+        assert all(isinstance(sentences, tuple)
+                   for sentences in dialogs_test._dialogs['en_US'].values())
 
         dialog_rendered = dialogs_test.get_dialog("en_US", "render_test", test="mytest")
         assert dialog_rendered == "This is a rendering test mytest"
@@ -32,3 +36,197 @@ class TestDialog(object):
 
         dialog_rendered = dialogs_test.get_dialog("en_US", "empty")
         assert dialog_rendered is None
+
+    def test_dialog_template_cache(self):
+        dialogs_test = DialogsHandler("tests/dialogs", "test_dialog", template_cache_size=1)
+        dialogs_test.load()
+
+        dialogs_test.get_dialog("en_US", "render_test", test="mytest")
+        assert len(dialogs_test._templates) == 1
+        template = list(dialogs_test._templates.values())[0]
+        dialog_rendered = dialogs_test.get_dialog("en_US", "render_test", test="other")
+        assert dialog_rendered == "This is a rendering test other"
+        assert list(dialogs_test._templates.values())[0] is template
+
+        # Cache is bounded
+        dialogs_test._get_template("en_US", "test", "{{ a }}")
+        assert len(dialogs_test._templates) == 1
+
+        # Reload drops compiled templates
+        dialogs_test.load()
+        assert dialogs_test._templates == {}
+
+    def test_dialog_template_cache_threads(self):
+        dialogs_test = DialogsHandler("tests/dialogs", "test_dialog", template_cache_size=4)
+        dialogs_test.load()
+        errors = []
+
+        def render(thread_id):
+            try:
+                for index in range(500):
+                    dialogs_test._get_template("en_US", "test", "{{ a }} %d" % (index % 8))
+                    if thread_id == 0 and index % 50 == 0:
+                        dialogs_test._forget([("en_US", "test")])
+            except Exception as exp:
+                errors.append(exp)
+
+        threads = [threading.Thread(target=render, args=(thread_id,)) for thread_id in range(6)]
+        # Switch threads often to hit races
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+        assert errors == []
+        assert len(dialogs_test._templates) <= 4
+
+    def test_dialog_selection(self):
+        with pytest.raises(TuxEatPiError):
+            DialogsHandler("tests/dialogs", "test_dialog", selection="bad_mode")
+
+        dialogs_test = DialogsHandler("tests/dialogs", "test_dialog", selection="no_repeat")
+        dialogs_test.load()
+        last_dialog = dialogs_test.get_dialog("en_US", "test")
+        for _ in range(10):
+            dialog = dialogs_test.get_dialog("en_US", "test")
+            assert dialog != last_dialog
+            last_dialog = dialog
+
+        dialogs_test = DialogsHandler("tests/dialogs", "test_dialog", selection="round_robin")
+        dialogs_test.load()
+        dialogs = [dialogs_test.get_dialog("en_US", "test") for _ in range(4)]
+        assert set(dialogs) == {'This is a test', 'This is an other test'}
+        assert dialogs[0] == dialogs[2] and dialogs[1] == dialogs[3]
+
+    def test_dialog_reload(self, tmpdir):
+        lang_dir = tmpdir.mkdir("en_US")
+        lang_dir.join("hello.dialog").write("Hello\n")
+        lang_dir.join("bye.dialog").write("Bye\n")
+        dialogs_test = DialogsHandler(str(tmpdir), "test_dialog")
+        dialogs_test.load()
+        assert dialogs_test.get_dialog("en_US", "hello") == "Hello"
+        assert dialogs_test.reload() == []
+
+        # Changed file
+        lang_dir.join("hello.dialog").write("Hi there\n")
+        os.utime(str(lang_dir.join("hello.dialog")), ns=(0, 0))
+        assert dialogs_test.reload() == [("en_US", "hello")]
+        assert dialogs_test.get_dialog("en_US", "hello") == "Hi there"
+        # Deleted file
+        lang_dir.join("bye.dialog").remove()
+        assert dialogs_test.reload() == [("en_US", "bye")]
+        assert dialogs_test.get_dialog("en_US", "bye") is None
+
+    def test_dialog_watch(self, tmpdir):
+        lang_dir = tmpdir.mkdir("en_US")
+        lang_dir.join("hello.dialog").write("Hello\n")
+        dialogs_test = DialogsHandler(str(tmpdir), "test_dialog", hot_reload=True)
+        dialogs_test.load()
+        reload_threads = []
+        reload_ = dialogs_test.reload
+        dialogs_test.reload = lambda: reload_threads.append(threading.current_thread()) or reload_()
+
+        async def change():
+            lang_dir.join("hello.dialog").write("Hi there\n")
+            os.utime(str(lang_dir.join("hello.dialog")), ns=(0, 0))
+            await asyncio.sleep(0.1)
+            dialogs_test.stop()
+
+        async def run():
+            await asyncio.gather(dialogs_test.async_watch(interval=0.02), change())
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(run())
+        loop.close()
+        assert dialogs_test.get_dialog("en_US", "hello") == "Hi there"
+        # Files are scanned out of the event loop thread
+        assert reload_threads and threading.current_thread() not in reload_threads
+
+    def test_dialog_lazy(self):
+        dialogs_test = DialogsHandler("tests/dialogs", "test_dialog", lazy=True)
+        dialogs_test.load()
+        assert dialogs_test._dialogs == {}
+
+        dialog_rendered = dialogs_test.get_dialog("en_US", "render_test", test="mytest")
+        assert dialog_rendered == "This is a rendering test mytest"
+        assert list(dialogs_test._dialogs) == ["en_US"]
+
+        dialog_rendered = dialogs_test.get_dialog("bad_lang", "render_test", test="mytest")
+        assert dialog_rendered is None
+
+        dialogs_test.set_language("fr_FR")
+        assert dialogs_test._dialogs == {}
+        assert dialogs_test._files == {}
+
+        dialogs_test.set_language("en_US")
+        assert set(dialogs_test._dialogs["en_US"]) == {"render_test", "empty", "test"}
+        assert dialogs_test.reload() == []
+
+        dialogs_test.load(["en_US"])
+        assert list(dialogs_test._dialogs) == ["en_US"]
+
+    def test_dialog_lazy_threads(self, tmpdir):
+        for language in ("en_US", "fr_FR"):
+            lang_dir = tmpdir.mkdir(language)
+            for index in range(20):
+                lang_dir.join("key%d.dialog" % index).write("%s %d\n" % (language, index))
+        dialogs_test = DialogsHandler(str(tmpdir), "test_dialog", lazy=True)
+        dialogs_test.load(["en_US"])
+        errors = []
+
+        def run(thread_id):
+            try:
+                for index in range(200):
+                    if thread_id == 0:
+                        dialogs_test.set_language(("fr_FR", "en_US")[index % 2])
+                    elif thread_id == 1:
+                        dialogs_test.reload()
+                    else:
+                        dialogs_test.get_dialog(("fr_FR", "en_US")[index % 2], "key1")
+            except Exception as exp:
+                errors.append(exp)
+
+        threads = [threading.Thread(target=run, args=(thread_id,)) for thread_id in range(4)]
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+        assert errors == []
+        # Files and dialogs are still consistent
+        assert set(language for _, language, _ in dialogs_test._files.values()) == \
+            set(dialogs_test._dialogs)
+        dialogs_test.set_language("fr_FR")
+        assert list(dialogs_test._dialogs) == ["fr_FR"]
+        assert dialogs_test.reload() == []
+
+    def test_dialog_bundle(self, tmpdir):
+        bundle_path = str(tmpdir.join("dialogs.bundle"))
+        assert DialogsHandler("tests/dialogs", "test_dialog").compile(bundle_path) == (3, 3)
+
+        dialogs_test = DialogsHandler(bundle_path, "test_dialog")
+        dialogs_test.load()
+        assert set(dialogs_test._dialogs["en_US"]["test"]) == {'This is a test',
+                                                               'This is an other test'}
+        dialog_rendered = dialogs_test.get_dialog("en_US", "render_test", test="mytest")
+        assert dialog_rendered == "This is a rendering test mytest"
+        assert dialogs_test.get_dialog("en_US", "empty") is None
+        assert dialogs_test.reload() == []
+
+        dialogs_test = DialogsHandler(bundle_path, "test_dialog", lazy=True)
+        dialogs_test.load()
+        assert dialogs_test._dialogs == {}
+        assert dialogs_test.get_dialog("en_US", "test") in ('This is a test',
+                                                            'This is an other test')
+
+        tmpdir.join("bad.bundle").write("bad")
+        with pytest.raises(TuxEatPiError):
+            DialogsHandler(str(tmpdir.join("bad.bundle")), "test_dialog").load()
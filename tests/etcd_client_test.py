@@ -0,0 +1,174 @@
+import sys
+import os
+import time
+import threading
+import logging
+
+import etcd
+import pytest
+
+from tuxeatpi_common.etcd_client import EtcdCache, EtcdWrapper, CircuitBreaker, backoff_delays
+
+
+class FakeResult(object):
+
+    def __init__(self, modified_index, etcd_index=None, key=None):
+        self.modifiedIndex = modified_index
+        self.etcd_index = modified_index if etcd_index is None else etcd_index
+        self.key = key
+
+
+class TestEtcdCache(object):
+
+    def test_cache(self):
+        cache = EtcdCache(max_size=2, ttl=60)
+        cache.prefixes.append("/memory")
+        assert cache.covers("/memory/test/key")
+        assert not cache.covers("/memoryother")
+
+        assert cache.get("/memory/test/key", False) is None
+        cache.set("/memory/test/key", False, FakeResult(10))
+        assert cache.get("/memory/test/key", False).modifiedIndex == 10
+        assert cache.stats == {"hits": 1, "misses": 1, "size": 1}
+
+        # Older change does not invalidate
+        cache.invalidate("/memory/test/key", 10)
+        assert cache.get("/memory/test/key", False) is not None
+        # Change in a child invalidates the recursive read of its parent
+        cache.set("/memory/test", True, FakeResult(5, 10))
+        cache.invalidate("/memory/test/key", 11)
+        assert cache.get("/memory/test", True) is None
+        assert cache.get("/memory/test/key", False) is None
+
+        # Size bound
+        for index in range(3):
+            cache.set("/memory/test/key{}".format(index), False, FakeResult(index))
+        assert cache.stats["size"] == 2
+        assert cache.get("/memory/test/key0", False) is None
+
+        # TTL
+        cache.ttl = -1
+        cache.set("/memory/test/key", False, FakeResult(12))
+        assert cache.get("/memory/test/key", False) is None
+
+        cache.clear("/memory")
+        assert cache.stats["size"] == 0
+
+    def test_cache_stale_result(self):
+        cache = EtcdCache(max_size=2, ttl=60)
+        # Read before a change seen by the watch
+        cache.invalidate("/memory/test/key", 20)
+        cache.set("/memory/test/key", False, FakeResult(15, 19))
+        assert cache.get("/memory/test/key", False) is None
+        cache.set("/memory/test", True, FakeResult(15, 19))
+        assert cache.get("/memory/test", True) is None
+        # Read after the change
+        cache.set("/memory/test/key", False, FakeResult(20, 20))
+        assert cache.get("/memory/test/key", False) is not None
+        # Unrelated key
+        cache.set("/memory/other", False, FakeResult(15, 19))
+        assert cache.get("/memory/other", False) is not None
+        # Forgotten changes still reject older results
+        cache.invalidate("/memory/key1", 30)
+        cache.invalidate("/memory/key2", 31)
+        cache.set("/memory/other", False, FakeResult(15, 25))
+        assert cache.get("/memory/other", False) is not None
+        cache.set("/memory/new", False, FakeResult(15, 19))
+        assert cache.get("/memory/new", False) is None
+
+
+class TestRetry(object):
+
+    def test_backoff_delays(self):
+        delays = backoff_delays(base=1, cap=4)
+        for max_delay in (1, 2, 4, 4, 4):
+            assert 0 <= next(delays) <= max_delay
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+        assert breaker.allow()
+        breaker.failure()
+        assert not breaker.is_open
+        breaker.failure()
+        assert breaker.is_open
+        assert not breaker.allow()
+        time.sleep(0.2)
+        # Half open
+        assert breaker.allow()
+        assert not breaker.allow()
+        breaker.success()
+        assert not breaker.is_open
+        assert breaker.allow()
+
+    def test_retry_budget(self):
+        etcd_wrapper = EtcdWrapper(None, None, retry_budget=0.5)
+        etcd_wrapper.port = 1
+        etcd_wrapper.sync_client = etcd.Client("127.0.0.1", 1)
+        start_time = time.time()
+        assert etcd_wrapper.read("/retry_test") is None
+        assert time.time() - start_time < 1.5
+
+
+class FakeWatchClient(object):
+
+    def __init__(self):
+        self.events = [FakeResult(index, key="/cache_test/key") for index in (11, 12)]
+
+    def read(self, key):
+        return FakeResult(10)
+
+    def watch(self, key, index=None, timeout=None, recursive=None):
+        if self.events:
+            return self.events.pop(0)
+        time.sleep(0.01)
+        raise etcd.EtcdWatchTimedOut("Watch timed out")
+
+
+class TestConnect(object):
+
+    def test_connect_budget(self):
+        # Etcd not reachable: the wrapper is created after the retry budget
+        start_time = time.time()
+        etcd_wrapper = EtcdWrapper("127.0.0.1", 1, retry_budget=0.5)
+        assert time.time() - start_time < 1.5
+        assert etcd_wrapper.read("/connect_test") is None
+
+
+class TestEtcdWrapperCache(object):
+
+    def test_cache_watch_stop(self):
+        etcd_wrapper = EtcdWrapper.__new__(EtcdWrapper)
+        etcd_wrapper.logger = logging.getLogger("tep")
+        etcd_wrapper.sync_client = FakeWatchClient()
+        etcd_wrapper.cache = None
+        etcd_wrapper._cache_watchers = []
+        etcd_wrapper.enable_cache(["/cache_test"])
+        cache = etcd_wrapper.cache
+        time.sleep(0.1)
+        assert cache._changes == {"/cache_test/key": 12}
+        old_watcher = etcd_wrapper._cache_watchers[0]
+        etcd_wrapper.disable_cache()
+        # New watchers for a new cache, old ones stop
+        etcd_wrapper.enable_cache(["/cache_test"])
+        old_watcher.join(1)
+        assert not old_watcher.is_alive()
+        assert etcd_wrapper._cache_watchers[-1].is_alive()
+        etcd_wrapper.disable_cache()
+        for watcher in etcd_wrapper._cache_watchers:
+            watcher.join(1)
+            assert not watcher.is_alive()
+
+    def test_wrapper_cache(self):
+        etcd_wrapper = EtcdWrapper(None, None)
+        other_wrapper = EtcdWrapper(None, None)
+        etcd_wrapper.write("/cache_test/key", "value1")
+        etcd_wrapper.enable_cache(["/cache_test"])
+        assert etcd_wrapper.read("/cache_test/key").value == '"value1"'
+        assert etcd_wrapper.read("/cache_test/key").value == '"value1"'
+        assert etcd_wrapper.cache.stats["hits"] == 1
+        # Changes from an other client are seen through the watch
+        other_wrapper.write("/cache_test/key", "value2")
+        time.sleep(0.5)
+        assert etcd_wrapper.read("/cache_test/key").value == '"value2"'
+        etcd_wrapper.disable_cache()
+        etcd_wrapper.delete("/cache_test", recursive=True)
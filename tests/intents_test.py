@@ -7,7 +7,7 @@ import logging
 import pytest
 
 from tuxeatpi_common.error import TuxEatPiError
-from tuxeatpi_common.intents import IntentsHandler
+from tuxeatpi_common.intents import IntentsHandler, compress_intent, decompress_intent
 from tuxeatpi_common.etcd_client import EtcdWrapper
 
 
@@ -43,7 +43,7 @@ class TestIntents(object):
         assert resp is None
 
         self.thread = self.thread.start()
-        self.intents_test.save("nlu_test")
+        self.intents_test.save("nlu_test", force=True)
         time.sleep(1)
         assert self.test == "OK"
 
@@ -60,3 +60,75 @@ class TestBadIntents(object):
         intents_test = IntentsHandler("tests/badintents", "test_intents", etcd_wrapper)
         ret = intents_test.save("nlu_test")
         assert ret is None
+
+
+class TestConcurrentIntents(object):
+
+    def test_intents_concurrency(self):
+        etcd_wrapper = EtcdWrapper(None, None)
+        for concurrency in (1, 8):
+            intents_test = IntentsHandler("tests/intents", "test_intents_concurrency",
+                                          etcd_wrapper, concurrency=concurrency)
+            etcd_wrapper.delete("/intents/nlu_test", recursive=True)
+            intents_test.save("nlu_test", force=True)
+            resp = intents_test.read("nlu_test", wait=False)
+            intents = [intent for intent in resp.children
+                       if "test_intents_concurrency" in intent.key]
+            assert len(intents) == 1
+            assert intents[0].value == "NLU test file\n"
+
+
+class TestUnchangedIntents(object):
+
+    def test_intents_unchanged(self):
+        etcd_wrapper = EtcdWrapper(None, None)
+        intents_test = IntentsHandler("tests/intents", "test_intents_unchanged", etcd_wrapper)
+        intents_test.save("nlu_test", force=True)
+        key = "/intents/nlu_test/en_US/context/test_intents_unchanged/test_file.nlu"
+        index = etcd_wrapper.read(key).modifiedIndex
+        # Unchanged intents are not sent again
+        intents_test.save("nlu_test")
+        assert etcd_wrapper.read(key).modifiedIndex == index
+        # Unless forced
+        intents_test.save("nlu_test", force=True)
+        assert etcd_wrapper.read(key).modifiedIndex > index
+        # Or deleted from etcd
+        etcd_wrapper.delete("/intents/nlu_test", recursive=True)
+        intents_test.save("nlu_test")
+        assert etcd_wrapper.read(key).value == "NLU test file\n"
+
+    def test_intents_write_failed(self):
+        class FailingWrapper(object):
+            def write(self, key, value, serialize=True):
+                return None
+
+        intents_test = IntentsHandler("tests/intents", "test_intents_failed", FailingWrapper())
+        intent_path = "tests/intents/nlu_test/en_US/context/test_file.nlu"
+        # The manifest entry is not updated
+        assert intents_test._save_intent("test_file", "/key", intent_path,
+                                         known_hash="old") == (0, "old")
+        assert intents_test._save_intent("test_file", "/key", intent_path) == (0, None)
+
+
+class TestCompressedIntents(object):
+
+    def test_intents_compression(self):
+        with pytest.raises(TuxEatPiError):
+            IntentsHandler("tests/intents", "test_intents_compression", None,
+                           compression="bad_codec")
+        assert decompress_intent("NLU test file\n") == "NLU test file\n"
+        for codec in ("zlib", "lzma"):
+            value = compress_intent(b"NLU test file\n", codec)
+            assert value.startswith("tep:{}:".format(codec))
+            assert decompress_intent(value) == "NLU test file\n"
+
+        etcd_wrapper = EtcdWrapper(None, None)
+        intents_test = IntentsHandler("tests/intents", "test_intents_compression",
+                                      etcd_wrapper, compression="zlib")
+        intents_test.save("nlu_test", force=True)
+        key = "/intents/nlu_test/en_US/context/test_intents_compression/test_file.nlu"
+        assert etcd_wrapper.read(key).value.startswith("tep:zlib:")
+        resp = intents_test.read("nlu_test", wait=False)
+        intents = [intent for intent in resp.children
+                   if "test_intents_compression" in intent.key]
+        assert intents[0].value == "NLU test file\n"
@@ -1,3 +1,5 @@
+import asyncio
+import json
 import sys
 import os
 import time
@@ -29,3 +31,130 @@ class TestMemory(object):
 
         resp = memory_test.read(key)
         assert resp == {}
+
+    def test_memory_write_behind(self):
+        etcd_wrapper = EtcdWrapper(None, None)
+        memory_test = MemoryHandler("test_memory_write_behind", etcd_wrapper, flush_interval=60)
+        memory_test.delete("counter")
+        for value in range(10):
+            memory_test.save("counter", value)
+        # Not written yet but readable
+        assert etcd_wrapper.read("/memory/test_memory_write_behind/counter") is None
+        assert memory_test.read("counter") == 9
+
+        memory_test.flush()
+        data = etcd_wrapper.read("/memory/test_memory_write_behind/counter")
+        assert data.value == "9"
+
+        memory_test.save("counter", 10)
+        memory_test.stop()
+        assert memory_test.read("counter") == 10
+        assert memory_test._pending == {}
+
+        memory_test.delete("counter")
+        assert memory_test.read("counter") == {}
+
+    def test_memory_delete_during_flush(self):
+
+        class SlowWrapper(object):
+
+            def __init__(self):
+                self.data = {}
+
+            def write(self, key, value, codec=None):
+                time.sleep(0.2)
+                self.data[key] = json.dumps(value)
+                return True
+
+            def read(self, key):
+                if key not in self.data:
+                    return None
+                return type("Result", (object,), {"value": self.data[key]})
+
+            def delete(self, key, recursive=False):
+                self.data.pop(key, None)
+
+        etcd_wrapper = SlowWrapper()
+        memory_test = MemoryHandler("test_memory_delete", etcd_wrapper, flush_interval=60)
+        memory_test.save("counter", 1)
+        flusher = threading.Thread(target=memory_test.flush)
+        flusher.start()
+        time.sleep(0.05)
+        memory_test.delete("counter")
+        assert memory_test.read("counter") == {}
+        flusher.join()
+        assert memory_test.read("counter") == {}
+        assert etcd_wrapper.data == {}
+        memory_test.stop()
+
+        # Buffered values are copied
+        value = {"items": [1]}
+        memory_test.save("list", value)
+        value["items"].append(2)
+        assert memory_test.read("list") == {"items": [1]}
+        memory_test.flush()
+        assert json.loads(etcd_wrapper.data["/memory/test_memory_delete/list"]) == {"items": [1]}
+        memory_test.stop()
+
+    def test_memory_bulk(self):
+        etcd_wrapper = EtcdWrapper(None, None)
+        memory_test = MemoryHandler("test_memory_bulk", etcd_wrapper)
+        memory_test.delete("")
+        memory_test.save_many({"key1": "value1", "dir/key2": {"a": 1}})
+
+        assert memory_test.read_many(["key1", "dir/key2", "missing"]) == {
+            "key1": "value1", "dir/key2": {"a": 1}, "missing": {}}
+        assert dict(memory_test.scan()) == {"key1": "value1", "dir/key2": {"a": 1}}
+        assert dict(memory_test.scan("dir")) == {"dir/key2": {"a": 1}}
+
+        memory_test.delete("")
+        assert dict(memory_test.scan()) == {}
+
+    def test_memory_read_many_prefix(self):
+
+        class Node(object):
+
+            def __init__(self, key, value):
+                self.key = key
+                self.value = value
+                self.dir = False
+
+        class RecordingWrapper(object):
+
+            def __init__(self, data):
+                self.data = data
+                self.reads = []
+
+            def read(self, key, recursive=False):
+                self.reads.append(key)
+                nodes = [Node(node_key, value) for node_key, value in self.data.items()
+                         if node_key == key or node_key.startswith(key + "/")]
+                if not nodes:
+                    return None
+                return type("Result", (object,), {"value": nodes[0].value, "leaves": nodes})
+
+        root = "/memory/test_memory_read_many"
+        etcd_wrapper = RecordingWrapper({root + "/dir/key1": '"value1"',
+                                         root + "/dir/key2": '"value2"',
+                                         root + "/other": '"other"'})
+        memory_test = MemoryHandler("test_memory_read_many", etcd_wrapper)
+        # Only the common folder is read
+        assert memory_test.read_many(["dir/key1", "dir/key2"]) == {"dir/key1": "value1",
+                                                                   "dir/key2": "value2"}
+        assert etcd_wrapper.reads == [root + "/dir"]
+        # No common folder, one read per key
+        etcd_wrapper.reads = []
+        assert memory_test.read_many(["dir/key1", "other"]) == {"dir/key1": "value1",
+                                                                "other": "other"}
+        assert etcd_wrapper.reads == [root + "/dir/key1", root + "/other"]
+
+    def test_memory_async(self):
+        etcd_wrapper = EtcdWrapper(None, None)
+        memory_test = MemoryHandler("test_memory_async", etcd_wrapper)
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(memory_test.async_save("mykey", {"a": 1}))
+        assert loop.run_until_complete(memory_test.async_read("mykey")) == {"a": 1}
+        assert memory_test.read("mykey") == {"a": 1}
+        loop.run_until_complete(memory_test.async_delete("mykey"))
+        assert loop.run_until_complete(memory_test.async_read("mykey")) == {}
+        loop.close()
@@ -1,3 +1,4 @@
+import json
 import sys
 import os
 import time
@@ -28,3 +29,29 @@ class TestDaemon(object):
         with pytest.raises(TuxEatPiError) as exp:
             message = Message(topic, data)
         assert str(exp.value) == "Missing `arguments` key in `data` dict"
+
+    def test_payload(self):
+        message = Message("fakedaemon.set_config", {"arguments": {"config": {}}})
+        assert message._payload is None
+        payload = message.payload
+        assert message.payload is payload
+        assert json.loads(payload) == {"topic": "fakedaemon.set_config",
+                                       "data": {"arguments": {"config": {}}},
+                                       "context": "general",
+                                       "source": None}
+        with pytest.raises(AttributeError):
+            message.other = 1
+
+    def test_from_payload(self):
+        payload = json.dumps({"topic": "fakedaemon.help",
+                              "data": {"arguments": {"help_arg": "test"}},
+                              "context": "general",
+                              "source": "fakedaemon"})
+        message = Message.from_payload(payload)
+        assert message.topic == "fakedaemon.help"
+        assert message.data == {"arguments": {"help_arg": "test"}}
+        assert message.source == "fakedaemon"
+        # Forwarded as is
+        assert message.payload is payload
+        with pytest.raises(TuxEatPiError):
+            Message.from_payload(json.dumps({"topic": "fakedaemon.help", "data": {}}))
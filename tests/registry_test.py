@@ -1,12 +1,14 @@
+import asyncio
 import sys
 import os
 import time
 import threading
 import logging
 
+import etcd
 import pytest
 
-from tuxeatpi_common.registry import RegistryHandler
+from tuxeatpi_common.registry import RegistryHandler, RegistryView
 from tuxeatpi_common.etcd_client import EtcdWrapper
 
 
@@ -32,3 +34,117 @@ class TestRegistry(object):
         registry_test.clear()
         states = registry_test.read()
         assert states == {}
+
+    def test_registry_async(self):
+        etcd_wrapper = EtcdWrapper(None, None)
+        registry_test = RegistryHandler("test_registry_async", "0.2", etcd_wrapper)
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(registry_test.async_ping())
+        states = loop.run_until_complete(registry_test.async_read())
+        assert states['test_registry_async']['version'] == "0.2"
+        assert states['test_registry_async']['state'] == "ALIVE"
+        registry_test.clear()
+        loop.close()
+
+    def test_registry_ttl(self):
+        etcd_wrapper = EtcdWrapper(None, None)
+        registry_test = RegistryHandler("test_registry_ttl", "0.3", etcd_wrapper, ttl=2)
+        registry_test.ping()
+        # Next pings only refresh the TTL
+        registry_test.ping()
+        data = etcd_wrapper.read(registry_test.key)
+        assert data.ttl is not None
+        assert registry_test.read()['test_registry_ttl']['state'] == "ALIVE"
+        # State change writes the whole record
+        registry_test.ping("BUSY")
+        assert registry_test.read()['test_registry_ttl']['state'] == "BUSY"
+        # Record expires without ping
+        time.sleep(3)
+        assert 'test_registry_ttl' not in registry_test.read()
+        # And is written again on next ping
+        registry_test.ping("BUSY")
+        assert registry_test.read()['test_registry_ttl']['state'] == "BUSY"
+        registry_test.clear()
+
+    def test_registry_ttl_last_record(self):
+        etcd_wrapper = EtcdWrapper(None, None)
+        registry_test = RegistryHandler("test_registry_ttl_last", "0.3", etcd_wrapper, ttl=1)
+        registry_test.clear()
+        registry_test.ping()
+        assert list(registry_test.read()) == ['test_registry_ttl_last']
+        # The registry folder stays empty when its only record expires
+        time.sleep(2)
+        assert registry_test.read() == {}
+
+
+class TestRegistryView(object):
+
+    def test_registry_view(self):
+        etcd_wrapper = EtcdWrapper(None, None)
+        registry_test = RegistryHandler("test_registry_view", "0.4", etcd_wrapper)
+        registry_test.clear()
+        registry_test.ping()
+
+        view = RegistryView(etcd_wrapper, watch_timeout=1)
+        changes = []
+        view.add_callback(lambda name, old, new: changes.append((name, old, new)))
+        view.start()
+        assert view.states['test_registry_view']['state'] == "ALIVE"
+        assert changes[0][0] == 'test_registry_view'
+
+        registry_test.ping("BUSY")
+        time.sleep(0.5)
+        assert view.states['test_registry_view']['state'] == "BUSY"
+        assert changes[-1][1]['state'] == "ALIVE"
+        assert changes[-1][2]['state'] == "BUSY"
+
+        registry_test.clear()
+        time.sleep(0.5)
+        assert view.states == {}
+        assert changes[-1][2] is None
+        start_time = time.time()
+        view.stop()
+        # No registry change needed to stop
+        assert time.time() - start_time < 2
+
+    def test_registry_view_stop(self):
+
+        class IdleWrapper(object):
+
+            def read(self, key, recursive=False):
+                return type("Result", (object,), {"etcd_index": 1, "leaves": []})
+
+            def watch(self, key, recursive=False, index=None, timeout=None):
+                time.sleep(timeout)
+                raise etcd.EtcdWatchTimedOut("Watch timed out")
+
+        view = RegistryView(IdleWrapper(), watch_timeout=0.1)
+        view.start()
+        watcher = view._watcher
+        view.stop()
+        assert not watcher.is_alive()
+
+    def test_registry_view_bad_record(self):
+
+        class IdleWrapper(object):
+
+            def read(self, key, recursive=False):
+                result = etcd.EtcdResult(node={
+                    "key": "/registry", "dir": True, "nodes": [
+                        {"key": "/registry/good", "value": '{"state": "ALIVE"}'},
+                        {"key": "/registry/bad", "value": "not json"}]})
+                result.etcd_index = 1
+                return result
+
+        view = RegistryView(IdleWrapper())
+        view.load()
+        assert view.states == {"good": {"state": "ALIVE"}}
+
+        states = view.states
+        view._apply(etcd.EtcdResult(action="set", node={
+            "key": "/registry/good", "value": "tep:bad_codec:", "modifiedIndex": 2}))
+        view._apply(etcd.EtcdResult(action="set", node={
+            "key": "/registry/other", "value": '{"state": "BUSY"}', "modifiedIndex": 3}))
+        assert view.states == {"good": {"state": "ALIVE"}, "other": {"state": "BUSY"}}
+        # States are replaced, not changed in place
+        assert states == {"good": {"state": "ALIVE"}}
@@ -0,0 +1,36 @@
+import sys
+import os
+import time
+import threading
+import logging
+
+import pytest
+
+from tuxeatpi_common.error import TuxEatPiError
+from tuxeatpi_common.serializers import get_codec, decode_value, AVAILABLE_CODECS
+
+
+class TestSerializers(object):
+
+    def test_codecs(self):
+        value = {"name": "test", "date": 1.5, "params": [1, "two", None, True]}
+        for name, available in AVAILABLE_CODECS.items():
+            if not available:
+                continue
+            codec = get_codec(name)
+            data = codec.encode(value)
+            assert isinstance(data, str)
+            assert codec.decode(data) == value
+            # Values are self describing
+            assert decode_value(data) == value
+
+        # Legacy json values
+        assert decode_value('{"a": 1}') == {"a": 1}
+        assert decode_value('"myvalue"') == "myvalue"
+        assert get_codec().decode(get_codec("json").encode(value)) == value
+
+    def test_bad_codec(self):
+        with pytest.raises(TuxEatPiError):
+            get_codec("bad_codec")
+        with pytest.raises(TuxEatPiError):
+            decode_value("tep:bad_codec:data")
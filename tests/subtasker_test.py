@@ -0,0 +1,47 @@
+import asyncio
+import sys
+import os
+import time
+import threading
+import logging
+
+import pytest
+
+from tuxeatpi_common.subtasker import PeriodicTask
+
+
+class TestPeriodicTask(object):
+
+    def test_periodic_task(self):
+        loop = asyncio.new_event_loop()
+        calls = []
+        task = PeriodicTask(0.05, lambda: calls.append(loop.time()), jitter=0.1)
+        task.start(loop)
+        # Start is idempotent
+        task.start(loop)
+        loop.run_until_complete(asyncio.sleep(0.52))
+        task.stop()
+        assert 9 <= len(calls) <= 11
+        assert task.runs == len(calls)
+        # Deadlines are absolute, delays do not accumulate
+        assert calls[-1] - calls[0] < 0.05 * (len(calls) - 1) + 0.05 * 0.1 + 0.02
+        assert task.max_lateness < 0.05
+        loop.close()
+
+    def test_periodic_coroutine(self):
+        loop = asyncio.new_event_loop()
+        calls = []
+
+        async def slow_job():
+            calls.append(loop.time())
+            await asyncio.sleep(0.12)
+
+        task = PeriodicTask(0.05, slow_job, jitter=0)
+        task.start(loop)
+        loop.run_until_complete(asyncio.sleep(0.33))
+        task.stop()
+        loop.run_until_complete(asyncio.sleep(0))
+        # Runs do not overlap
+        assert task.skipped > 0
+        assert len(calls) + task.skipped == task.runs
+        loop.close()
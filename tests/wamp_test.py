@@ -0,0 +1,294 @@
+import asyncio
+import json
+import sys
+import os
+import time
+import threading
+import logging
+
+import pytest
+
+from tuxeatpi_common.error import TuxEatPiError
+from tuxeatpi_common.message import Message
+from tuxeatpi_common.wamp import TopicDispatcher, TopicTrie, WampClient, is_wamp_topic, is_wamp_rpc
+from tuxeatpi_common.wamp import get_wamp_methods, MessageBatcher
+
+
+class TestTopicDispatcher(object):
+
+    def test_serial_topic(self):
+        dispatcher = TopicDispatcher(4)
+        results = []
+        lock = threading.Lock()
+        running = []
+
+        def handler(value):
+            with lock:
+                running.append(value)
+                assert len(running) == 1
+            time.sleep(0.01)
+            results.append(value)
+            with lock:
+                running.remove(value)
+
+        for value in range(10):
+            dispatcher.submit("test.serial", lambda value=value: handler(value))
+        dispatcher.shutdown()
+        # Serial topic handlers run in order, one at a time
+        assert results == list(range(10))
+
+    def test_concurrent_topic(self):
+        dispatcher = TopicDispatcher(4)
+        start_time = time.time()
+        for _ in range(8):
+            dispatcher.submit("test.concurrent", lambda: time.sleep(0.1), serial=False)
+        dispatcher.shutdown()
+        assert time.time() - start_time < 0.5
+
+    def test_backpressure(self):
+        dispatcher = TopicDispatcher(1, queue_size=2)
+        event = threading.Event()
+        dispatcher.submit("test.bp", event.wait)
+        dispatcher.submit("test.bp", lambda: None)
+        # Queue full: submit blocks until an handler ends
+        submitted = threading.Event()
+
+        def submit():
+            dispatcher.submit("test.bp", lambda: None)
+            submitted.set()
+
+        threading.Thread(target=submit).start()
+        assert not submitted.wait(0.2)
+        event.set()
+        assert submitted.wait(1)
+        dispatcher.shutdown()
+
+    def test_handler_error(self):
+        dispatcher = TopicDispatcher(1, queue_size=1)
+        dispatcher.submit("test.error", lambda: 1 / 0)
+        results = []
+        dispatcher.submit("test.error", lambda: results.append(1))
+        dispatcher.shutdown()
+        assert results == [1]
+
+
+class FakeComponent(object):
+
+    name = "fake"
+
+    def __init__(self):
+        self.loop = None
+        self.results = []
+
+    def get_running_loop(self):
+        return self.loop
+
+    @is_wamp_topic("sync_topic")
+    def sync_topic(self, value):
+        self.results.append(value)
+
+    @is_wamp_topic("async_topic", max_concurrency=2)
+    async def async_topic(self, value):
+        self.running = getattr(self, "running", 0) + 1
+        self.max_running = max(getattr(self, "max_running", 0), self.running)
+        await asyncio.sleep(0.05)
+        self.running -= 1
+        self.results.append(value)
+
+    @is_wamp_topic("global.lang.changed", root=True)
+    def lang_changed(self, value):
+        self.results.append(("lang", value))
+
+    @is_wamp_topic("global..status", root=True, match="wildcard")
+    def any_status(self, value):
+        self.results.append(("status", value))
+
+    @is_wamp_rpc("async_rpc")
+    async def async_rpc(self, value):
+        await asyncio.sleep(0.01)
+        return value * 2
+
+
+class TestAsyncHandlers(object):
+
+    def test_async_handlers(self):
+        component = FakeComponent()
+        client = WampClient(component)
+        meta = {"topic": "fake.async_topic", "subscription_id": 1}
+        # No running event loop, coroutine runs in the current thread
+        client._call_topic(component.async_topic, {"value": 1}, "{}", meta)
+        assert component.results == [1]
+        assert client._run_coroutine(component.async_rpc, (2,), {}).result() == 4
+        # Semaphores of the temporary event loop are dropped
+        assert client._semaphores == {}
+
+        # Coroutines are scheduled on the component event loop
+        component.loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=component.loop.run_forever)
+        thread.start()
+        try:
+            start_time = time.time()
+            for value in range(6):
+                client._call_topic(component.async_topic, {"value": value}, "{}", meta)
+            # Not blocking
+            assert time.time() - start_time < 0.05
+            assert client._wrap_async_rpc(component.async_rpc)(3) == 6
+            time.sleep(0.3)
+            assert sorted(component.results[1:]) == list(range(6))
+            # Concurrency limit
+            assert component.max_running == 2
+            assert [key[0] for key in client._semaphores] == [component.loop]
+            # Bad arguments
+            client._call_topic(component.async_topic, {"bad": 1}, "{}", meta)
+            time.sleep(0.05)
+        finally:
+            component.loop.call_soon_threadsafe(component.loop.stop)
+            thread.join()
+            component.loop.close()
+
+        client._call_topic(component.sync_topic, {"value": 1}, "{}", meta)
+        assert client.handler_stats["async_topic"]["calls"] == 8
+        assert client.handler_stats["async_rpc"]["calls"] == 2
+        assert client.handler_stats["sync_topic"]["calls"] == 1
+        assert client.handler_stats["async_topic"]["max_time"] >= 0.05
+
+    def test_handler_stats_threads(self):
+        component = FakeComponent()
+        client = WampClient(component)
+        meta = {"topic": "fake.sync_topic", "subscription_id": 1}
+
+        def call():
+            for value in range(1000):
+                client._call_topic(component.sync_topic, {"value": value}, "{}", meta)
+
+        threads = [threading.Thread(target=call) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert client.handler_stats["sync_topic"]["calls"] == 8000
+
+
+class TestTopicRouting(object):
+
+    def test_topic_trie(self):
+        trie = TopicTrie()
+        trie.add("tuxeatpi.nlu", "nlu_prefix", match="prefix")
+        trie.add("tuxeatpi..status", "any_status")
+        trie.add("tuxeatpi.nlu.status", "nlu_status")
+        trie.add("..", "any_three")
+        assert trie.match("tuxeatpi.nlu.status") == "nlu_status"
+        assert trie.match("tuxeatpi.tts.status") == "any_status"
+        assert trie.match("tuxeatpi.nlu.text") == "any_three"
+        assert trie.match("tuxeatpi.nlu") == "nlu_prefix"
+        assert trie.match("tuxeatpi.nlu.text.fr") == "nlu_prefix"
+        assert trie.match("tuxeatpi.nlux") is None
+        assert trie.match("other") is None
+
+    def test_routes(self):
+        component = FakeComponent()
+        client = WampClient(component)
+        # Topics with several dots and root topics
+        for topic, value in (("fake.sync_topic", 1), ("global.lang.changed", 2),
+                             ("global..status", 3)):
+            message = Message(topic=topic, data={"arguments": {"value": value}})
+            client.on_message(message.payload, {"topic": topic, "subscription_id": 1})
+        assert component.results == [1, ("lang", 2), ("status", 3)]
+        assert client.get_route("global.nlu.status")[0] == component.any_status
+        assert client.get_route("fake.sync_topic")[1] is True
+        assert client.get_route("fake.async_topic")[2] is True
+        # Unknown topic
+        client.on_message("{}", {"topic": "fake.unknown", "subscription_id": 1})
+        assert len(component.results) == 3
+
+    def test_bad_match(self):
+        with pytest.raises(TuxEatPiError):
+            is_wamp_topic("test", match="exact")
+
+
+class TestMethodDiscovery(object):
+
+    def test_get_wamp_methods(self):
+
+        class Parent(object):
+
+            @is_wamp_topic("parent")
+            def parent(self):
+                pass
+
+            @is_wamp_rpc("overridden")
+            def overridden(self):
+                pass
+
+            @property
+            def prop(self):
+                raise Exception("Property evaluated")
+
+        class Child(Parent):
+
+            @is_wamp_rpc("child")
+            def child(self):
+                pass
+
+            def overridden(self):
+                pass
+
+            @staticmethod
+            @is_wamp_topic("static")
+            def static():
+                pass
+
+        assert sorted(get_wamp_methods(Parent)) == ["overridden", "parent"]
+        assert sorted(get_wamp_methods(Child)) == ["child", "parent", "static"]
+        # Cached in each class
+        assert Child.__dict__["_wamp_methods"] is get_wamp_methods(Child)
+        assert sorted(get_wamp_methods(Parent)) == ["overridden", "parent"]
+
+
+class TestMessageBatcher(object):
+
+    def test_batch(self):
+        sent = []
+        batcher = MessageBatcher(lambda topic, payload: sent.append((topic, payload)),
+                                 max_delay=0.1, max_size=3)
+        payloads = [Message("fake.status", {"arguments": {"value": i}}).payload
+                    for i in range(4)]
+        for payload in payloads:
+            batcher.add("fake.status", payload)
+        # max_size reached
+        assert len(sent) == 1
+        assert json.loads(sent[0][1]) == {"topic": "fake.status",
+                                          "batch": [json.loads(payload)
+                                                    for payload in payloads[:3]]}
+        # max_delay reached
+        time.sleep(0.3)
+        assert sent[1] == ("fake.status", payloads[3])
+        batcher.stop()
+
+    def test_coalesce(self):
+        sent = []
+        batcher = MessageBatcher(lambda topic, payload: sent.append((topic, payload)),
+                                 max_delay=10)
+        for value in range(5):
+            batcher.add("fake.status", str(value), coalesce=True)
+        batcher.add("fake.other", "other")
+        assert sent == []
+        batcher.stop()
+        assert sorted(sent) == [("fake.other", "other"), ("fake.status", "4")]
+        # Stopped batcher sends right away
+        batcher.add("fake.status", "5", coalesce=True)
+        assert sent[-1] == ("fake.status", "5")
+        assert batcher._pending == {}
+
+    def test_on_message_batch(self):
+        component = FakeComponent()
+        client = WampClient(component)
+        sent = []
+        client._send = lambda topic, payload: sent.append(payload)
+        for value in range(3):
+            client.publish(Message("fake.sync_topic", {"arguments": {"value": value}}),
+                           batch=True)
+        client.batcher.stop()
+        assert len(sent) == 1
+        client.on_message(sent[0], {"topic": "fake.sync_topic", "subscription_id": 1})
+        assert component.results == [0, 1, 2]
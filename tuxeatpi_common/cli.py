@@ -7,6 +7,7 @@ import click
 from setproctitle import setproctitle  # pylint: disable=E0611
 
 from tuxeatpi_common.daemon import TepBaseDaemon
+from tuxeatpi_common.dialogs import DialogsHandler
 
 DAEMON_CLASS = None
 
@@ -28,8 +29,8 @@ def set_daemon_class(class_object):
                               writable=True))
 @click.option('--intent-folder', '-I', required=True, help="Intent folder",
               type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True))
-@click.option('--dialog-folder', '-D', required=True, help="Dialog folder",
-              type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True))
+@click.option('--dialog-folder', '-D', required=True, help="Dialog folder or dialog bundle",
+              type=click.Path(exists=True, file_okay=True, dir_okay=True, readable=True))
 @click.option('--log-level', '-l', required=False, help="Log level", default="info",
               type=click.Choice(['debug', 'info', 'warning', 'error', 'critical']))
 def main_cli(workdir, intent_folder, dialog_folder, log_level, **kwargs):
@@ -54,9 +55,27 @@ def main_cli(workdir, intent_folder, dialog_folder, log_level, **kwargs):
     tep_daemon.start()
 
 
+@click.command()
+@click.option('--dialog-folder', '-D', required=True, help="Dialog folder",
+              type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True))
+@click.option('--output', '-o', required=True, help="Dialog bundle file",
+              type=click.Path(file_okay=True, dir_okay=False, writable=True))
+def compile_dialogs_cli(dialog_folder, output):
+    """Compile a dialog folder into a dialog bundle"""
+    dialogs = DialogsHandler(dialog_folder, "dialogs_compiler")
+    key_count, sentence_count = dialogs.compile(output)
+    click.echo("{} dialogs and {} sentences compiled in {}".format(
+        key_count, sentence_count, output))
+
+
 # Add cli command
 def cli(daemon_class=TepBaseDaemon):
     """Main function to call the cli"""
     set_daemon_class(daemon_class)
     # Run cli
     main_cli()  # pylint: disable=E1120
+
+
+def compile_dialogs():
+    """Main function to call the dialog compiler cli"""
+    compile_dialogs_cli()  # pylint: disable=E1120
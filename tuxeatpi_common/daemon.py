@@ -15,9 +15,15 @@ from tuxeatpi_common.etcd_client import EtcdWrapper
 
 
 class TepBaseDaemon(object):
-    """Base Daemon for TuxEatPi"""
+    """Base Daemon for TuxEatPi
 
-    def __init__(self, name, workdir, intents_folder, dialog_folder, logging_level=logging.INFO):
+    With `single_loop`, the main loop, settings watches and periodic tasks
+    (like heartbeats) all run on the daemon event loop instead of using a
+    subtasker thread with its own event loop.
+    """
+
+    def __init__(self, name, workdir, intents_folder, dialog_folder, logging_level=logging.INFO,
+                 single_loop=False):
         # Get event loop
         # self._async_loop = asyncio.get_event_loop()
         self._async_loop = asyncio.new_event_loop()
@@ -30,6 +36,7 @@ class TepBaseDaemon(object):
         # Get logger
         self.logger = None
         self.logging_level = logging_level
+        self.single_loop = single_loop
         self._get_logger()
         # Other component states
         self._component_states = {}
@@ -67,6 +74,20 @@ class TepBaseDaemon(object):
         self.shutdown()
 
     # Misc
+    def get_running_loop(self):
+        """Return the running event loop where coroutines can be scheduled
+
+        It is the daemon event loop in single loop mode, the subtasker one
+        otherwise. Returns None if it is not running yet.
+        """
+        if self.single_loop:
+            loop = self._async_loop
+        else:
+            loop = self._tasks_thread._async_loop  # pylint: disable=W0212
+        if loop is None or not loop.is_running():
+            return None
+        return loop
+
     def _get_logger(self):
         """Get logger"""
         self.logger = logging.getLogger(name="tep").getChild(self.name)
@@ -110,9 +131,32 @@ class TepBaseDaemon(object):
         """
         raise NotImplementedError
 
+    async def async_main_loop(self):
+        """Main loop used in single loop mode
+
+        By default, `main_loop` is run in an executor so it does not block
+        the event loop. Could be ReImplemented as a native coroutine.
+        """
+        await self._async_loop.run_in_executor(None, self.main_loop)
+
+    async def _async_start(self):
+        """Run subtasker tasks and the main loop on the daemon event loop"""
+        tasks = self._tasks_thread.attach(self._async_loop)
+        self.logger.info("Starting main loop")
+        try:
+            while self._run_main_loop:
+                await self.async_main_loop()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
     def start(self):
         """Startup function for main loop"""
         self._initializer.run()
+        if self.single_loop:
+            self._async_loop.run_until_complete(self._async_start())
+            return
         # Start main loop
         self.logger.info("Starting main loop")
         while self._run_main_loop:
@@ -124,6 +168,8 @@ class TepBaseDaemon(object):
         """Shutdown the daemon"""
         self.logger.info("Stopping %s", self.name)
         self.settings.stop()
+        self.dialogs.stop()
+        self.memory.stop()
         self._tasks_thread.stop()
         self._wamp_client.stop()
         self._run_main_loop = False
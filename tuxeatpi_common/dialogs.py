@@ -1,38 +1,297 @@
 """Module defining Dialog handler for voice"""
 
+import asyncio
+from collections import OrderedDict
 import logging
+import os
 from os import scandir
 from os.path import splitext
 import random
+import threading
 
 import jinja2
 
+from tuxeatpi_common.dialogs_bundle import open_bundle, write_bundle
+from tuxeatpi_common.error import TuxEatPiError
+
+
+SELECTION_MODES = ("random", "no_repeat", "round_robin")
+
 
 class DialogsHandler(object):
-    """Class getting dialog for voice"""
+    """Class getting dialog for voice
+
+    Sentences are picked according to `selection`:
+
+    * `random`: any sentence
+    * `no_repeat`: any sentence but the last one returned for the same key
+    * `round_robin`: each sentence in turn
+
+    With `hot_reload`, the subtasker polls the dialog folder and only
+    re-reads changed dialog files.
+
+    `dialog_folder` can also be a dialog bundle file built by `compile`,
+    which is mmaped instead of reading each dialog file.
+
+    With `lazy`, dialogs of a language are only loaded when the language is
+    set as the current one or requested by `get_dialog`.
+    """
 
-    def __init__(self, dialog_folder, component_name):
+    def __init__(self, dialog_folder, component_name, template_cache_size=256,
+                 selection="random", hot_reload=False, lazy=False):
+        if selection not in SELECTION_MODES:
+            raise TuxEatPiError("Bad dialog selection mode %s", selection)
         self.dialog_folder = dialog_folder
+        self.selection = selection
         self.logger = logging.getLogger(name="tep").getChild(component_name).getChild('dialog')
         self._dialogs = {}
+        # Guards dialogs and files, shared by the loop, watch and WAMP threads
+        self._dialogs_lock = threading.RLock()
+        # Shared jinja environment and compiled templates cache
+        self._jinja_env = jinja2.Environment()
+        self._templates = OrderedDict()
+        self._templates_lock = threading.Lock()
+        self.template_cache_size = template_cache_size
+        # Last sentence index returned by (language, key)
+        self._last_indexes = {}
+        # Loaded files: path -> ((mtime, size), language, key)
+        self._files = {}
+        # Opened dialog bundle: ((mtime, size), dialogs)
+        self._bundle = None
+        self.hot_reload = hot_reload
+        self.lazy = lazy
+        self._watching = False
+
+    def load(self, languages=None):
+        """Load dialogs from dialog folder
+
+        In lazy mode, only `languages` are loaded up front, the other ones
+        are loaded on demand by `get_dialog`
+        """
+        with self._dialogs_lock:
+            self._dialogs = {}
+            self._files = {}
+            self._bundle = None
+            with self._templates_lock:
+                self._templates.clear()
+            self._last_indexes.clear()
+            if not self.lazy or languages:
+                self.reload(languages)
+        self.logger.info('Dialogs loaded for languages: %s', ", ".join(sorted(self._dialogs)))
+        self.logger.debug('Dialogs loaded %s', self._dialogs)
+
+    def _get_language_dirs(self, languages):
+        """Return (language, path) of language folders to scan"""
+        if languages is None:
+            if not self.lazy:
+                return [(lang_dir.name, lang_dir.path)
+                        for lang_dir in scandir(self.dialog_folder) if lang_dir.is_dir()]
+            # Lazy mode: only look at already loaded languages
+            languages = list(self._dialogs)
+        lang_dirs = [(language, os.path.join(self.dialog_folder, language))
+                     for language in languages]
+        return [(language, lang_path) for language, lang_path in lang_dirs
+                if os.path.isdir(lang_path)]
+
+    def reload(self, languages=None):
+        """Reload only the dialog files changed since the last (re)load
+
+        Files are considered as changed when their mtime or size changed.
+        Deleted files are removed from the dialogs.
+        By default all languages are scanned, or only the loaded ones in
+        lazy mode.
+
+        Returns the list of changed (language, key)
+        """
+        with self._dialogs_lock:
+            if os.path.isfile(self.dialog_folder):
+                return self._reload_bundle(languages)
+            return self._reload_files(languages)
+
+    def _reload_files(self, languages=None):
+        """Reload languages from the dialog folder
+
+        Must be called with the dialogs lock held
+        """
+        changed = []
+        seen_files = set()
+        lang_dirs = self._get_language_dirs(languages)
+        for language, lang_path in lang_dirs:
+            self._dialogs.setdefault(language, {})
+            for dialog_file in scandir(lang_path):
+                if dialog_file.is_file() and splitext(dialog_file.path)[-1] == ".dialog":
+                    key = splitext(dialog_file.name)[0]
+                    seen_files.add(dialog_file.path)
+                    file_stat = dialog_file.stat()
+                    signature = (file_stat.st_mtime_ns, file_stat.st_size)
+                    if self._files.get(dialog_file.path, (None,))[0] == signature:
+                        continue
+                    self._dialogs[language][key] = self._read_file(dialog_file.path)
+                    self._files[dialog_file.path] = (signature, language, key)
+                    changed.append((language, key))
+        # Handle deleted files of scanned languages
+        scanned_languages = set(language for language, _ in lang_dirs)
+        if languages is None and not self.lazy:
+            scanned_languages = None
+        for file_path, (_, language, key) in list(self._files.items()):
+            if file_path in seen_files:
+                continue
+            if scanned_languages is not None and language not in scanned_languages:
+                continue
+            del self._files[file_path]
+            self._dialogs.get(language, {}).pop(key, None)
+            changed.append((language, key))
+        if changed:
+            self._forget(changed)
+            self.logger.debug('Dialogs reloaded %s', changed)
+        return changed
+
+    def _reload_bundle(self, languages=None):
+        """Reload languages from the dialog bundle
+
+        The bundle is reopened only if it changed.
+        Must be called with the dialogs lock held
+        """
+        bundle_stat = os.stat(self.dialog_folder)
+        signature = (bundle_stat.st_mtime_ns, bundle_stat.st_size)
+        reopened = self._bundle is None or self._bundle[0] != signature
+        if reopened:
+            self._bundle = (signature, open_bundle(self.dialog_folder))
+        bundle_dialogs = self._bundle[1]
+        if languages is None:
+            languages = list(self._dialogs) if self.lazy else list(bundle_dialogs)
+        changed = []
+        for language in languages:
+            if language not in bundle_dialogs:
+                continue
+            if not reopened and language in self._dialogs:
+                continue
+            old_keys = set(self._dialogs.get(language, {}))
+            self._dialogs[language] = dict(bundle_dialogs[language])
+            changed.extend((language, key) for key in old_keys.union(self._dialogs[language]))
+        if changed:
+            self._forget(changed)
+            self.logger.debug('Dialogs reloaded from bundle %s', changed)
+        return changed
+
+    def compile(self, bundle_path):
+        """Load the dialog folder and compile it into a dialog bundle"""
+        with self._dialogs_lock:
+            lazy = self.lazy
+            self.lazy = False
+            try:
+                self.load()
+            finally:
+                self.lazy = lazy
+            return write_bundle(self._dialogs, bundle_path)
+
+    def evict(self, language):
+        """Unload dialogs of a language"""
+        with self._dialogs_lock:
+            dialogs = self._dialogs.pop(language, None)
+            if dialogs is None:
+                return
+            self._forget([(language, key) for key in dialogs])
+            self._files = {file_path: file_data for file_path, file_data in self._files.items()
+                           if file_data[1] != language}
+        self.logger.info('Dialogs unloaded for language %s', language)
+
+    def set_language(self, language):
+        """Set the current language
+
+        In lazy mode, load dialogs of this language and unload other ones
+        """
+        if not self.lazy:
+            return
+        with self._dialogs_lock:
+            for loaded_language in list(self._dialogs):
+                if loaded_language != language:
+                    self.evict(loaded_language)
+            if language not in self._dialogs:
+                self.reload([language])
+                self.logger.info('Dialogs loaded for language %s', language)
+
+    @staticmethod
+    def _read_file(file_path):
+        """Read a dialog file and return its sentences"""
+        # Keep file order and drop duplicates
+        sentences = OrderedDict()
+        with open(file_path, "r") as dfh:
+            for sentence in dfh.readlines():
+                sentences[sentence.strip()] = None
+        return tuple(sentences)
+
+    def _forget(self, changed):
+        """Drop compiled templates and selection states of changed dialogs"""
+        changed = set(changed)
+        with self._templates_lock:
+            for cache_key in [cache_key for cache_key in self._templates
+                              if cache_key[:2] in changed]:
+                del self._templates[cache_key]
+        for changed_key in changed:
+            self._last_indexes.pop(changed_key, None)
+
+    async def async_watch(self, interval=1):
+        """Poll dialog folder and hot reload changed dialog files
+
+        This is done by the subtaskers. Files are scanned in the default
+        executor, so large dialog folders do not block the event loop.
+        """
+        loop = asyncio.get_event_loop()
+        self._watching = True
+        while self._watching:
+            await asyncio.sleep(interval)
+            try:
+                await loop.run_in_executor(None, self.reload)
+            except OSError as exp:
+                self.logger.error("Can not reload dialogs: %s", exp)
+
+    def stop(self):
+        """Stop watching dialog folder"""
+        self._watching = False
+
+    def _get_template(self, language, key, dialog):
+        """Return the compiled template of a dialog
+
+        Compiled templates are kept in a LRU cache, shared by threads
+        """
+        cache_key = (language, key, dialog)
+        with self._templates_lock:
+            template = self._templates.get(cache_key)
+            if template is not None:
+                self._templates.move_to_end(cache_key)
+                return template
+        # Compile outside of the lock
+        template = self._jinja_env.from_string(dialog)
+        with self._templates_lock:
+            self._templates[cache_key] = template
+            if len(self._templates) > self.template_cache_size:
+                self._templates.popitem(last=False)
+        return template
 
-    def load(self):
-        """Load dialogs from dialog folder"""
-        for lang_dir in scandir(self.dialog_folder):
-            if lang_dir.is_dir():
-                language = lang_dir.name
-                self._dialogs.setdefault(language, {})
-                for dialog_file in scandir(lang_dir.path):
-                    if dialog_file.is_file() and splitext(dialog_file.path)[-1] == ".dialog":
-                        key = splitext(dialog_file.name)[0]
-                        self._dialogs.get(language).setdefault(key, set())
-                        with open(dialog_file.path, "r") as dfh:
-                            for sentence in dfh.readlines():
-                                self._dialogs.get(language).get(key).add(sentence.strip())
-        self.logger.info('Dialogs loaded %s', self._dialogs)
+    def _select_index(self, language, key, size):
+        """Return the index of the next sentence to use"""
+        if self.selection == "random" or size == 1:
+            return random.randrange(size)
+        last_index = self._last_indexes.get((language, key))
+        if last_index is None:
+            index = random.randrange(size)
+        elif self.selection == "round_robin":
+            index = (last_index + 1) % size
+        else:
+            # no_repeat: pick among the other sentences
+            index = random.randrange(size - 1)
+            if index >= last_index:
+                index += 1
+        self._last_indexes[(language, key)] = index
+        return index
 
     def get_dialog(self, language, key, **kwargs):
         """Return one sentente related to a key and a language"""
+        if self.lazy and language not in self._dialogs:
+            with self._dialogs_lock:
+                if language not in self._dialogs:
+                    self.reload([language])
         if language not in self._dialogs:
             self.logger.error("Language %s not supported", language)
             return
@@ -44,8 +303,8 @@ class DialogsHandler(object):
         if not dialogs:
             self.logger.error("Empty dialog file %s for language %s", key, language)
             return
-        dialog = random.sample(dialogs, 1)[0]
+        dialog = dialogs[self._select_index(language, key, len(dialogs))]
         if kwargs:
-            template = jinja2.Template(dialog)
+            template = self._get_template(language, key, dialog)
             dialog = template.render(**kwargs)
         return dialog
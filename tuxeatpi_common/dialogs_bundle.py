@@ -0,0 +1,129 @@
+"""Module defining the binary dialog bundle format
+
+A dialog bundle is a single file holding all dialogs of a dialog folder.
+It is opened with `mmap`, only the index is parsed and sentences are decoded
+when they are used.
+
+Layout (little endian)::
+
+    header     magic (4s) | version (H) | key count (I) | sentence count (I)
+    key table  language offset, language size, key offset, key size,
+               first sentence, sentence count (6 * I) for each key
+    sentences  offset, size (2 * I) for each sentence
+    strings    utf-8 strings, offsets are relative to the strings start
+"""
+from collections.abc import Sequence
+import mmap
+import os
+import struct
+
+from tuxeatpi_common.error import TuxEatPiError
+
+
+BUNDLE_MAGIC = b"TEPD"
+BUNDLE_VERSION = 1
+HEADER = struct.Struct("<4sHII")
+KEY_ENTRY = struct.Struct("<IIIIII")
+SENTENCE_ENTRY = struct.Struct("<II")
+
+
+class BundleSentences(Sequence):
+    """Read only sequence of sentences stored in a mmaped bundle"""
+
+    __slots__ = ("_data", "_table_offset", "_strings_offset", "_first", "_count")
+
+    def __init__(self, data, table_offset, strings_offset, first, count):
+        self._data = data
+        self._table_offset = table_offset
+        self._strings_offset = strings_offset
+        self._first = first
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self[i] for i in range(*index.indices(self._count)))
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("sentence index out of range")
+        offset, size = SENTENCE_ENTRY.unpack_from(
+            self._data, self._table_offset + (self._first + index) * SENTENCE_ENTRY.size)
+        start = self._strings_offset + offset
+        return self._data[start:start + size].decode("utf-8")
+
+    def __repr__(self):
+        return repr(tuple(self))
+
+
+def write_bundle(dialogs, bundle_path):
+    """Write dialogs by language and key into a dialog bundle
+
+    The bundle is written in a temporary file and then moved, so a running
+    daemon never maps a half written bundle.
+    """
+    strings = bytearray()
+    string_offsets = {}
+
+    def add_string(string):
+        """Add a string in the strings table and return its offset and size"""
+        raw = string.encode("utf-8")
+        if raw not in string_offsets:
+            string_offsets[raw] = len(strings)
+            strings.extend(raw)
+        return string_offsets[raw], len(raw)
+
+    key_table = bytearray()
+    sentence_table = bytearray()
+    key_count = 0
+    sentence_count = 0
+    for language in sorted(dialogs):
+        for key in sorted(dialogs[language]):
+            sentences = dialogs[language][key]
+            key_table.extend(KEY_ENTRY.pack(*(add_string(language) + add_string(key) +
+                                              (sentence_count, len(sentences)))))
+            for sentence in sentences:
+                sentence_table.extend(SENTENCE_ENTRY.pack(*add_string(sentence)))
+            key_count += 1
+            sentence_count += len(sentences)
+
+    tmp_path = bundle_path + ".tmp"
+    with open(tmp_path, "wb") as bfh:
+        bfh.write(HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, key_count, sentence_count))
+        bfh.write(key_table)
+        bfh.write(sentence_table)
+        bfh.write(strings)
+    os.replace(tmp_path, bundle_path)
+    return key_count, sentence_count
+
+
+def open_bundle(bundle_path):
+    """Open a dialog bundle and return dialogs by language and key"""
+    with open(bundle_path, "rb") as bfh:
+        if os.fstat(bfh.fileno()).st_size < HEADER.size:
+            raise TuxEatPiError("%s is not a dialog bundle", bundle_path)
+        data = mmap.mmap(bfh.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, key_count, sentence_count = HEADER.unpack_from(data, 0)
+    if magic != BUNDLE_MAGIC:
+        raise TuxEatPiError("%s is not a dialog bundle", bundle_path)
+    if version != BUNDLE_VERSION:
+        raise TuxEatPiError("Dialog bundle version %s not supported", version)
+    key_offset = HEADER.size
+    sentence_offset = key_offset + key_count * KEY_ENTRY.size
+    strings_offset = sentence_offset + sentence_count * SENTENCE_ENTRY.size
+
+    def get_string(offset, size):
+        """Get a string from the strings table"""
+        start = strings_offset + offset
+        return data[start:start + size].decode("utf-8")
+
+    dialogs = {}
+    for entry in KEY_ENTRY.iter_unpack(data[key_offset:sentence_offset]):
+        lang_offset, lang_size, name_offset, name_size, first, count = entry
+        language = get_string(lang_offset, lang_size)
+        key = get_string(name_offset, name_size)
+        dialogs.setdefault(language, {})[key] = BundleSentences(data, sentence_offset,
+                                                                strings_offset, first, count)
+    return dialogs
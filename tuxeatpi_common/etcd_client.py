@@ -1,19 +1,205 @@
 """Module defintion function to get etcd client"""
+import asyncio
+from collections import OrderedDict
 import logging
 import os
+import random
+import threading
 import time
-import json
 import urllib3
 
 import aiohttp
 import aio_etcd
 import etcd
 
+from tuxeatpi_common.serializers import get_codec
+
+
+# Seconds before a watch returns without event, so watchers can stop
+WATCH_TIMEOUT = 5
+
+
+def backoff_delays(base=0.5, cap=30):
+    """Yield exponential backoff delays with full jitter
+
+    Jitter avoids all components retrying in lock-step after an outage
+    """
+    attempt = 0
+    while True:
+        yield random.uniform(0, min(cap, base * 2 ** attempt))
+        attempt += 1
+
+
+class CircuitBreaker(object):
+    """Circuit breaker for etcd requests
+
+    After `failure_threshold` consecutive failures the circuit opens and
+    requests fail immediately. After `reset_timeout` seconds, one request is
+    allowed to test the connection.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        """Return True if requests are rejected"""
+        return self.opened_at is not None
+
+    def allow(self):
+        """Return True if a request can be sent"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.reset_timeout:
+                # Half open: let one request go through
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def success(self):
+        """Record a successful request"""
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        """Record a failed request"""
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+
+
+class EtcdCache(object):
+    """Local cache of etcd read results
+
+    Entries expire after `ttl` seconds and the least recently used ones are
+    evicted when the cache holds more than `max_size` entries.
+
+    The etcd index of the last change of each key is kept, so a read result
+    older than a change seen by the watch is never cached.
+    """
+
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.prefixes = []
+        self._entries = OrderedDict()
+        # Last change index by key, and the highest index dropped from it
+        self._changes = OrderedDict()
+        self._min_index = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _related(key, other_key):
+        """Return True if a change of one key changes reads of the other"""
+        key = key.rstrip("/")
+        other_key = other_key.rstrip("/")
+        return (key == other_key or key.startswith(other_key + "/") or
+                other_key.startswith(key + "/"))
+
+    def _is_stale(self, key, result):
+        """Return True if a change happened after the result was read"""
+        index = getattr(result, "etcd_index", 0)
+        if index < self._min_index:
+            return True
+        return any(change_index > index and self._related(key, change_key)
+                   for change_key, change_index in self._changes.items())
+
+    def covers(self, key):
+        """Return True if the key is under a cached prefix"""
+        return any(key == prefix or key.startswith(prefix.rstrip("/") + "/")
+                   for prefix in self.prefixes)
+
+    def get(self, key, recursive):
+        """Return the cached result of a read or None"""
+        with self._lock:
+            entry = self._entries.get((key, recursive))
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            self._entries.move_to_end((key, recursive))
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, recursive, result):
+        """Save the result of a read
+
+        The result is dropped if it is older than a known change
+        """
+        with self._lock:
+            if self._is_stale(key, result):
+                return
+            self._entries[(key, recursive)] = (time.time() + self.ttl, result)
+            self._entries.move_to_end((key, recursive))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key, index=None):
+        """Drop cached results affected by a change of a key
+
+        The cached result of the key itself is kept if it is not older
+        than the change `index`
+        """
+        key = key.rstrip("/")
+        with self._lock:
+            if index is not None:
+                self._changes[key] = max(index, self._changes.get(key, 0))
+                self._changes.move_to_end(key)
+                while len(self._changes) > self.max_size:
+                    _, dropped_index = self._changes.popitem(last=False)
+                    self._min_index = max(self._min_index, dropped_index)
+            for entry_key in list(self._entries):
+                cached_key = entry_key[0].rstrip("/")
+                if cached_key == key:
+                    result = self._entries[entry_key][1]
+                    if index is not None and result.modifiedIndex >= index:
+                        continue
+                elif not (key.startswith(cached_key + "/") or
+                          cached_key.startswith(key + "/")):
+                    continue
+                del self._entries[entry_key]
+
+    def clear(self, prefix=None):
+        """Drop all cached results or only the ones under a prefix"""
+        with self._lock:
+            if prefix is None:
+                self._entries.clear()
+                return
+            prefix = prefix.rstrip("/")
+            for entry_key in list(self._entries):
+                if entry_key[0] == prefix or entry_key[0].startswith(prefix + "/"):
+                    del self._entries[entry_key]
+
+    @property
+    def stats(self):
+        """Return cache statistics"""
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
 
 class EtcdWrapper(object):
-    """Etcd Wrapper class to handle sync and async requests"""
+    """Etcd Wrapper class to handle sync and async requests
+
+    Each wrapper holds one sync client, keeping a pool of up to `pool_size`
+    keep-alive connections to etcd, and one async client using the aiohttp
+    default connection pool.
+    The sync client is thread safe and used for reads, writes and watches.
+
+    Requests failing on connection errors are retried with jittered
+    exponential backoff for up to `retry_budget` seconds, behind a circuit
+    breaker shared by all requests of the wrapper.
 
-    def __init__(self, host=None, port=None):
+    Values are serialized with `codec` unless an other one is given to `write`.
+    """
+
+    def __init__(self, host=None, port=None, pool_size=None, retry_budget=None, codec=None):
         # Get logger
         self.logger = logging.getLogger(name="tep").getChild('etcd_client')
         # Set host
@@ -26,18 +212,41 @@ class EtcdWrapper(object):
             self.port = int(os.environ.get("TEP_ETCD_PORT", 2379))
         else:
             self.port = port
+        # Set connection pool size
+        if pool_size is None:
+            self.pool_size = int(os.environ.get("TEP_ETCD_POOL_SIZE", 10))
+        else:
+            self.pool_size = pool_size
+        # Set retry budget in seconds
+        if retry_budget is None:
+            self.retry_budget = float(os.environ.get("TEP_ETCD_RETRY_BUDGET", 10))
+        else:
+            self.retry_budget = retry_budget
+        self.breaker = CircuitBreaker()
+        # Set default codec
+        self.codec = get_codec(codec or os.environ.get("TEP_ETCD_CODEC"))
         # Get clients
         self.sync_client = None
-        self.sync_sender = None
         self.async_client = None
         self._connect()
+        # Local cache, see enable_cache
+        self.cache = None
+        self._cache_watchers = []
 
     def _connect(self):
-        """Return an etcd client"""
-        # Get sync client receiver
-        while True:
+        """Return an etcd client
+
+        The connection is tested for up to `retry_budget` seconds. If etcd
+        is still not reachable, the client is created without test and
+        requests go through the retries and the circuit breaker until etcd
+        comes back.
+        """
+        # Get sync client
+        deadline = time.time() + self.retry_budget
+        for delay in backoff_delays():
             try:
-                etcd_client = etcd.Client(self.host, self.port, allow_reconnect=True)
+                etcd_client = etcd.Client(self.host, self.port, allow_reconnect=True,
+                                          per_host_pool_size=self.pool_size)
                 # Test connection
                 etcd_client.cluster_version  # pylint: disable=W0104
                 # Save client
@@ -46,81 +255,276 @@ class EtcdWrapper(object):
             except (etcd.EtcdConnectionFailed,
                     urllib3.exceptions.MaxRetryError,
                     etcd.EtcdException):
-                self.logger.warning("Can not connect to etcd server, retrying in 5 seconds")
-                time.sleep(5)
-        # Get sync client sender
-        while True:
-            try:
-                etcd_sender = etcd.Client(self.host, self.port, allow_reconnect=True)
-                # Test connection
-                etcd_sender.cluster_version  # pylint: disable=W0104
-                # Save client
-                self.sync_sender = etcd_sender
-                break
-            except (etcd.EtcdConnectionFailed,
-                    urllib3.exceptions.MaxRetryError,
-                    etcd.EtcdException):
-                self.logger.warning("Can not connect to etcd server, retrying in 5 seconds")
-                time.sleep(5)
+                delay = min(delay, deadline - time.time())
+                if delay <= 0:
+                    self.logger.warning("Can not connect to etcd server, "
+                                        "requests will be retried")
+                    # Does not contact etcd on creation
+                    self.sync_client = etcd.Client(self.host, self.port,
+                                                   per_host_pool_size=self.pool_size)
+                    break
+                self.logger.warning("Can not connect to etcd server, retrying in %.1f seconds",
+                                    delay)
+                time.sleep(delay)
         # Get async etcd client
         self.async_client = aio_etcd.Client(self.host, self.port, allow_reconnect=True)
 
+    def _retry(self, func, *args, **kwargs):
+        """Call a sync client method, retrying on connection errors
+
+        Raises EtcdConnectionFailed when the circuit is open or the retry
+        budget is spent
+        """
+        deadline = time.time() + self.retry_budget
+        for delay in backoff_delays():
+            if not self.breaker.allow():
+                raise etcd.EtcdConnectionFailed("Circuit breaker open")
+            try:
+                result = func(*args, **kwargs)
+            except etcd.EtcdWatchTimedOut:
+                # Not a connection error
+                raise
+            except etcd.EtcdConnectionFailed:
+                self.breaker.failure()
+                if time.time() + delay > deadline:
+                    raise
+                self.logger.warning("Etcd request failed, retrying in %.1f seconds", delay)
+                time.sleep(delay)
+                continue
+            self.breaker.success()
+            return result
+
+    async def _async_retry(self, func, *args, **kwargs):
+        """Call an async client method, retrying on connection errors
+
+        Raises EtcdConnectionFailed when the circuit is open or the retry
+        budget is spent
+        """
+        deadline = time.time() + self.retry_budget
+        for delay in backoff_delays():
+            if not self.breaker.allow():
+                raise aio_etcd.EtcdConnectionFailed("Circuit breaker open")
+            try:
+                result = await func(*args, **kwargs)
+            except aio_etcd.EtcdWatchTimedOut:
+                # Not a connection error
+                raise
+            except (aio_etcd.EtcdConnectionFailed, aiohttp.ClientError):
+                self.breaker.failure()
+                if time.time() + delay > deadline:
+                    raise
+                self.logger.warning("Etcd request failed, retrying in %.1f seconds", delay)
+                await asyncio.sleep(delay)
+                continue
+            self.breaker.success()
+            return result
+
+    def enable_cache(self, prefixes, max_size=1024, ttl=60):
+        """Serve reads of keys under prefixes from a local cache
+
+        The cache is kept up to date by a recursive watch on each prefix
+        """
+        if self.cache is None:
+            self.cache = EtcdCache(max_size, ttl)
+        self._cache_watchers = [watcher for watcher in self._cache_watchers
+                                if watcher.is_alive()]
+        for prefix in prefixes:
+            if prefix in self.cache.prefixes:
+                continue
+            # Get the current index before serving reads from the cache
+            # so the watch does not miss any change
+            index = self.sync_client.read("/").etcd_index
+            self.cache.prefixes.append(prefix)
+            watcher = threading.Thread(target=self._watch_cache,
+                                       args=(self.cache, prefix, index + 1),
+                                       daemon=True)
+            watcher.start()
+            self._cache_watchers.append(watcher)
+
+    def _watch_cache(self, cache, prefix, index):
+        """Invalidate cached results on changes under a prefix
+
+        The watch stops when `cache` is disabled or replaced
+        """
+        while self.cache is cache:
+            try:
+                event = self.sync_client.watch(prefix, index=index, timeout=WATCH_TIMEOUT,
+                                               recursive=True)
+            except etcd.EtcdWatchTimedOut:
+                continue
+            except (etcd.EtcdException, urllib3.exceptions.HTTPError) as exp:
+                self.logger.warning("Cache watch on %s failed: %s", prefix, exp)
+                if self.cache is not cache:
+                    break
+                # Changes can be missed, restart from scratch
+                cache.clear(prefix)
+                time.sleep(1)
+                try:
+                    index = self.sync_client.read("/").etcd_index + 1
+                except (etcd.EtcdException, urllib3.exceptions.HTTPError):
+                    index = None
+                continue
+            cache.invalidate(event.key, event.modifiedIndex)  # pylint: disable=E1101
+            index = event.modifiedIndex + 1  # pylint: disable=E1101
+
+    def disable_cache(self):
+        """Stop serving reads from the local cache
+
+        Cache watchers stop within `WATCH_TIMEOUT` seconds
+        """
+        self.cache = None
+
     def read(self, key, recursive=False, wait=False, timeout=60):
-        """Sync Etcd read operation"""
+        """Sync Etcd read operation
+
+        If the cache is enabled, non waiting reads are served from it
+        """
+        cache = self.cache
+        use_cache = cache is not None and not wait and cache.covers(key)
+        if use_cache:
+            result = cache.get(key, recursive)
+            if result is not None:
+                return result
         try:
-            return self.sync_client.read(key, recursive=recursive, wait=wait, timeout=timeout)
+            result = self._retry(self.sync_client.read, key, recursive=recursive,
+                                 wait=wait, timeout=timeout)
+            if use_cache:
+                cache.set(key, recursive, result)
+            return result
         except etcd.EtcdKeyNotFound:
             self.logger.warning("key %s not found in Etcd", key)
             return None
         except etcd.EtcdConnectionFailed:
-            # TODO Retry ? or just pass ?
             self.logger.error("Can not read to etcd %s:%s with key %s. Connection lost ?",
                               self.host, self.port, key)
             return None
 
-    def eternal_watch(self, key, recursive=False):
+    def eternal_watch(self, key, recursive=False, index=None):
         """Sync Etcd watch operation"""
         try:
-            return self.sync_client.eternal_watch(key, recursive=recursive)
+            return self.sync_client.eternal_watch(key, index=index, recursive=recursive)
         except etcd.EtcdKeyNotFound:
             self.logger.warning("key %s not found in Etcd", key)
             return None
         except etcd.EtcdConnectionFailed:
-            # TODO Retry ? or just pass ?
             self.logger.error("Can not read to etcd %s:%s with key %s. Connection lost ?",
                               self.host, self.port, key)
             return None
 
-    def write(self, key, value, serialize=True):
+    def watch(self, key, recursive=False, index=None, timeout=WATCH_TIMEOUT):
+        """Sync Etcd watch operation returning the next change
+
+        Raises EtcdWatchTimedOut if nothing changed within `timeout` seconds
+        """
+        return self.sync_client.watch(key, index=index, timeout=timeout, recursive=recursive)
+
+    def write(self, key, value, serialize=True, codec=None, ttl=None):
         """Sync Etcd write operation"""
         if serialize:
-            data = json.dumps(value)
+            data = (codec or self.codec).encode(value)
         else:
             data = value
+        if self.cache is not None:
+            self.cache.invalidate(key)
         try:
-            return self.sync_sender.write(key, data)
+            return self._retry(self.sync_client.write, key, data, ttl=ttl)
         except etcd.EtcdConnectionFailed:
-            # TODO Retry ? or just pass ?
             self.logger.error("Can not write to etcd %s:%s with key %s. Connection lost ?",
                               self.host, self.port, key)
 
+    def refresh(self, key, ttl):
+        """Sync Etcd TTL refresh operation
+
+        The value is not sent and watchers are not notified.
+        Returns None if the key does not exist anymore
+        """
+        if self.cache is not None:
+            self.cache.invalidate(key)
+        try:
+            return self._retry(self.sync_client.refresh, key, ttl)
+        except etcd.EtcdKeyNotFound:
+            self.logger.debug("key %s not found in Etcd, can not refresh it", key)
+            return None
+        except etcd.EtcdConnectionFailed:
+            self.logger.error("Can not refresh etcd %s:%s key %s. Connection lost ?",
+                              self.host, self.port, key)
+            return None
+
     def delete(self, key, recursive=False):
         """Sync Etcd delete operation"""
+        if self.cache is not None:
+            self.cache.invalidate(key)
         try:
-            self.sync_client.delete(key, recursive=recursive)
+            self._retry(self.sync_client.delete, key, recursive=recursive)
         except etcd.EtcdKeyNotFound:
             # TODO log
             pass
+        except etcd.EtcdConnectionFailed:
+            self.logger.error("Can not delete in etcd %s:%s with key %s. Connection lost ?",
+                              self.host, self.port, key)
 
-    async def async_read(self, key, wait=False):
+    async def async_read(self, key, wait=False, recursive=False):
         """Async Etcd read operation"""
+        cache = self.cache
+        use_cache = cache is not None and not wait and cache.covers(key)
+        if use_cache:
+            result = cache.get(key, recursive)
+            if result is not None:
+                return result
         try:
-            return await self.async_client.read(key, wait=wait)
+            result = await self._async_retry(self.async_client.read, key, wait=wait,
+                                             recursive=recursive)
+            if use_cache:
+                cache.set(key, recursive, result)
+            return result
         except aio_etcd.EtcdKeyNotFound:
             self.logger.warning("key %s not found in Etcd", key)
             return None
-        except aiohttp.client_exceptions.ClientPayloadError:
-            # TODO Retry ? or just pass ?
+        except (aio_etcd.EtcdConnectionFailed, aiohttp.ClientError):
             self.logger.error("Can not read to etcd %s:%s with key %s. Connection lost ?",
                               self.host, self.port, key)
             return None
+
+    async def async_write(self, key, value, serialize=True, codec=None, ttl=None):
+        """Async Etcd write operation"""
+        if serialize:
+            data = (codec or self.codec).encode(value)
+        else:
+            data = value
+        if self.cache is not None:
+            self.cache.invalidate(key)
+        try:
+            return await self._async_retry(self.async_client.write, key, data, ttl=ttl)
+        except (aio_etcd.EtcdConnectionFailed, aiohttp.ClientError):
+            self.logger.error("Can not write to etcd %s:%s with key %s. Connection lost ?",
+                              self.host, self.port, key)
+
+    async def async_refresh(self, key, ttl):
+        """Async Etcd TTL refresh operation
+
+        The value is not sent and watchers are not notified.
+        Returns None if the key does not exist anymore
+        """
+        if self.cache is not None:
+            self.cache.invalidate(key)
+        try:
+            return await self._async_retry(self.async_client.refresh, key, ttl)
+        except aio_etcd.EtcdKeyNotFound:
+            self.logger.debug("key %s not found in Etcd, can not refresh it", key)
+            return None
+        except (aio_etcd.EtcdConnectionFailed, aiohttp.ClientError):
+            self.logger.error("Can not refresh etcd %s:%s key %s. Connection lost ?",
+                              self.host, self.port, key)
+            return None
+
+    async def async_delete(self, key, recursive=False):
+        """Async Etcd delete operation"""
+        if self.cache is not None:
+            self.cache.invalidate(key)
+        try:
+            await self._async_retry(self.async_client.delete, key, recursive=recursive)
+        except aio_etcd.EtcdKeyNotFound:
+            pass
+        except (aio_etcd.EtcdConnectionFailed, aiohttp.ClientError):
+            self.logger.error("Can not delete in etcd %s:%s with key %s. Connection lost ?",
+                              self.host, self.port, key)
@@ -29,4 +29,6 @@ class Initializer(object):
         if not self.skip_intents:
             self.component.intents.save(self.component.settings.nlu_engine)
         # Start subtasker
-        self.component._tasks_thread.start()
+        # In single loop mode, the daemon runs it on its own event loop
+        if not self.component.single_loop:
+            self.component._tasks_thread.start()
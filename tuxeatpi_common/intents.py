@@ -1,30 +1,90 @@
 """Module defining how to handle intents"""
+import base64
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import logging
+import lzma
 import os
+import time
+import zlib
 
 from tuxeatpi_common.error import TuxEatPiError
+from tuxeatpi_common.serializers import decode_value
+
+
+# Compressed intent values are stored as `tep:<codec>:<base64 data>`
+COMPRESSION_PREFIX = "tep:"
+COMPRESSION_CODECS = {"zlib": (zlib.compress, zlib.decompress),
+                      "lzma": (lzma.compress, lzma.decompress),
+                      }
+
+
+def compress_intent(intent_data, codec):
+    """Compress intent data and return the etcd value"""
+    if codec not in COMPRESSION_CODECS:
+        raise TuxEatPiError("Compression codec %s not supported", codec)
+    compressed = COMPRESSION_CODECS[codec][0](intent_data)
+    return "".join((COMPRESSION_PREFIX, codec, ":", base64.b64encode(compressed).decode()))
+
+
+def decompress_intent(value):
+    """Return intent data from an etcd value
+
+    Values without compression marker are returned as is
+    """
+    if not value or not value.startswith(COMPRESSION_PREFIX):
+        return value
+    codec, _, data = value[len(COMPRESSION_PREFIX):].partition(":")
+    if codec not in COMPRESSION_CODECS:
+        return value
+    return COMPRESSION_CODECS[codec][1](base64.b64decode(data)).decode("utf-8")
+
+
+def _decompress_nodes(nodes):
+    """Decompress intent values of etcd nodes in place"""
+    for node in nodes:
+        if node.get('value') is not None:
+            node['value'] = decompress_intent(node['value'])
+        _decompress_nodes(node.get('nodes', []))
+
+
+def decompress_result(result):
+    """Decompress intent values of an etcd result in place"""
+    if result is None:
+        return None
+    if result.value is not None:
+        result.value = decompress_intent(result.value)
+    _decompress_nodes(result._children)  # pylint: disable=W0212
+    return result
 
 
 class IntentsHandler(object):
     """Intents handler class"""
 
-    def __init__(self, intent_folder, component_name, etcd_wrapper):
+    def __init__(self, intent_folder, component_name, etcd_wrapper, concurrency=4,
+                 compression=None):
+        if compression is not None and compression not in COMPRESSION_CODECS:
+            raise TuxEatPiError("Compression codec %s not supported", compression)
         self.logger = logging.getLogger(name="tep").getChild(component_name).getChild('intents')
         self.etcd_wrapper = etcd_wrapper
         self.root_key = "/intents"
+        self.manifest_root_key = "/intents_manifests"
         self.folder = intent_folder
         self.name = component_name
+        self.concurrency = concurrency
+        self.compression = compression
 
-    def save(self, nlu_engine):
-        """Save intent in etcd"""
+    def _get_intent_files(self, nlu_engine):
+        """Return (intent id, etcd key, file path) of all intent files"""
         intent_folder = os.path.join(self.folder, nlu_engine)
         if not os.path.exists(intent_folder):
             self.logger.warning("No intent folder %s found, "
                                 "intent no will be sent to the nlu engine",
                                 intent_folder)
-            return
+            return []
         elif not os.path.isdir(intent_folder):
             raise TuxEatPiError("%s is not a folder", intent_folder)
+        intent_files = []
         for lang_folder in os.scandir(intent_folder):
             intent_lang = lang_folder.name.replace("-", "_")
             if lang_folder.is_dir():
@@ -33,29 +93,124 @@ class IntentsHandler(object):
                     for intent_file in os.scandir(intent_folder.path):
                         if intent_file.is_file():
                             intent_id = "/".join((intent_lang, intent_name, intent_file.name))
-                            with open(intent_file.path, "rb") as mfh:
-                                intent_data = mfh.read()
-                                key = os.path.join(self.root_key,
-                                                   nlu_engine,
-                                                   intent_lang,
-                                                   intent_name,
-                                                   self.name,
-                                                   intent_file.name)
-                                if intent_data:
-                                    self.etcd_wrapper.write(key, intent_data, serialize=False)
-                                    self.logger.info("Intent %s saved", intent_id)
+                            key = os.path.join(self.root_key,
+                                               nlu_engine,
+                                               intent_lang,
+                                               intent_name,
+                                               self.name,
+                                               intent_file.name)
+                            intent_files.append((intent_id, key, intent_file.path))
+        return intent_files
+
+    def _save_intent(self, intent_id, key, intent_path, known_hash=None):
+        """Save one intent file in etcd
+
+        The file is not sent if its content hash is `known_hash`
+
+        Returns the size of the saved data and the content hash, or
+        `known_hash` if the file could not be saved
+        """
+        with open(intent_path, "rb") as mfh:
+            intent_data = mfh.read()
+        if not intent_data:
+            return 0, None
+        intent_hash = hashlib.sha256(intent_data).hexdigest()
+        if self.compression is not None:
+            # Changing the codec must rewrite the intent
+            intent_hash = ":".join((self.compression, intent_hash))
+        if intent_hash == known_hash:
+            self.logger.debug("Intent %s unchanged", intent_id)
+            return 0, intent_hash
+        if self.compression is not None:
+            intent_data = compress_intent(intent_data, self.compression)
+        if self.etcd_wrapper.write(key, intent_data, serialize=False) is None:
+            # Keep the known hash so the intent is sent again next time
+            self.logger.error("Intent %s not saved", intent_id)
+            return 0, known_hash
+        self.logger.info("Intent %s saved", intent_id)
+        return len(intent_data), intent_hash
+
+    def _get_manifest_key(self, nlu_engine):
+        """Return the key of the intent hashes manifest
+
+        The manifest is kept outside of the intent folder so saving it
+        does not wake up the nlu engine watchers
+        """
+        return os.path.join(self.manifest_root_key, nlu_engine, self.name)
+
+    def _read_manifest(self, nlu_engine):
+        """Return saved intent hashes by etcd key"""
+        raw_data = self.etcd_wrapper.read(self._get_manifest_key(nlu_engine))
+        if raw_data is None:
+            return {}
+        try:
+            return decode_value(raw_data.value)  # pylint: disable=E1101
+        except (ValueError, TuxEatPiError):
+            self.logger.warning("Bad intent manifest for %s, ignoring it", nlu_engine)
+            return {}
+
+    def _get_saved_keys(self, nlu_engine):
+        """Return etcd keys of the intents saved for a nlu engine
+
+        This is one recursive read of all the nlu engine intents
+        """
+        result = self.etcd_wrapper.read(os.path.join(self.root_key, nlu_engine),
+                                        recursive=True)
+        if result is None:
+            return set()
+        return set(node.key for node in result.leaves if not node.dir)
+
+    def save(self, nlu_engine, force=False):
+        """Save intent in etcd
+
+        Intent files are sent concurrently, using up to `concurrency` requests.
+        Unless `force` is set, files with the same content hash as the last
+        saved ones are not sent again, if they are still in etcd.
+        """
+        start_time = time.time()
+        intent_files = self._get_intent_files(nlu_engine)
+        if not intent_files:
+            return
+        manifest = {} if force else self._read_manifest(nlu_engine)
+        if manifest:
+            # Intents can be deleted from etcd without the manifest
+            saved_keys = self._get_saved_keys(nlu_engine)
+            manifest = {key: intent_hash for key, intent_hash in manifest.items()
+                        if key in saved_keys}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = list(executor.map(
+                lambda args: self._save_intent(*args, known_hash=manifest.get(args[1])),
+                intent_files))
+        new_manifest = {intent_file[1]: intent_hash
+                        for intent_file, (_, intent_hash) in zip(intent_files, results)
+                        if intent_hash is not None}
+        if new_manifest != manifest:
+            self.etcd_wrapper.write(self._get_manifest_key(nlu_engine), new_manifest)
+        sizes = [size for size, _ in results if size]
+        unchanged = [intent_hash for size, intent_hash in results if not size and intent_hash]
+        self.logger.info("%d intent files (%d bytes) saved, %d unchanged, in %.3f seconds",
+                         len(sizes), sum(sizes), len(unchanged), time.time() - start_time)
 
     def read(self, nlu_engine, recursive=True, wait=True, timeout=30):
-        """Read intent in etcd"""
+        """Read intent in etcd
+
+        Compressed intents are decompressed
+        """
         key = os.path.join(self.root_key,
                            nlu_engine,
                            )
-        return self.etcd_wrapper.read(key, recursive=recursive,
-                                      wait=wait, timeout=timeout)
+        return decompress_result(self.etcd_wrapper.read(key, recursive=recursive,
+                                                        wait=wait, timeout=timeout))
 
     def eternal_watch(self, nlu_engine, recursive=True):
-        """Watch for changes in etcd"""
+        """Watch for changes in etcd
+
+        Compressed intents are decompressed
+        """
         key = os.path.join(self.root_key,
                            nlu_engine,
                            )
-        return self.etcd_wrapper.eternal_watch(key, recursive=recursive)
+        results = self.etcd_wrapper.eternal_watch(key, recursive=recursive)
+        if results is None:
+            return None
+        return (decompress_result(result) for result in results)
@@ -1,31 +1,200 @@
 """Module to handle key/value memory in Etcd"""
-import json
+import asyncio
+import copy
+import logging
 import os
+import threading
+
+from tuxeatpi_common.serializers import decode_value, get_codec
 
 
 class MemoryHandler(object):
-    """Memory handler class"""
+    """Memory handler class
+
+    With `flush_interval` (in seconds), saves are buffered and written to
+    etcd by a background thread every `flush_interval` seconds. Only the
+    last value saved for a key during this window is written.
 
-    def __init__(self, component_name, etcd_wrapper):
+    Values are serialized with `codec`, or the etcd wrapper one by default.
+    """
+
+    def __init__(self, component_name, etcd_wrapper, flush_interval=None, codec=None):
         self.root_key = os.path.join("/memory", component_name)
         self.etcd_wrapper = etcd_wrapper
+        self.logger = logging.getLogger(name="tep").getChild(component_name).getChild('memory')
+        self.flush_interval = flush_interval
+        self.codec = None if codec is None else get_codec(codec)
+        # Pending writes: etcd key -> value
+        self._pending = {}
+        # Writes being flushed
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self._stop_event = threading.Event()
+
+    def _buffer(self, key, value):
+        """Add a write to the pending writes
+
+        The value is copied, so later changes made by the caller are not saved
+        """
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._pending[key] = value
+            if self._flusher is None:
+                self._stop_event.clear()
+                self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+                self._flusher.start()
+
+    def _get_pending(self, key):
+        """Return (True, value) if the key has a pending write, (False, None) otherwise"""
+        with self._lock:
+            for pending in (self._pending, self._flushing):
+                if key in pending:
+                    # Not flushed yet, return a copy as if read from etcd
+                    return True, copy.deepcopy(pending[key])
+        return False, None
+
+    def _drop_pending(self, key):
+        """Drop pending and flushing writes of a key and its children"""
+        with self._lock:
+            for pending in (self._pending, self._flushing):
+                for pending_key in list(pending):
+                    if pending_key == key or pending_key.startswith(key + "/"):
+                        del pending[pending_key]
 
     def save(self, key, value):
         """Save something in memory"""
         key = os.path.join(self.root_key, key)
-        self.etcd_wrapper.write(key, value)
+        if self.flush_interval is None:
+            self.etcd_wrapper.write(key, value, codec=self.codec)
+        else:
+            self._buffer(key, value)
+
+    async def async_save(self, key, value):
+        """Save something in memory without blocking the event loop"""
+        key = os.path.join(self.root_key, key)
+        if self.flush_interval is None:
+            await self.etcd_wrapper.async_write(key, value, codec=self.codec)
+        else:
+            self._buffer(key, value)
 
     def read(self, key):
         """Read something in memory"""
         key = os.path.join(self.root_key, key)
+        found, value = self._get_pending(key)
+        if found:
+            return value
         data = self.etcd_wrapper.read(key)
         if data is not None:
             # TODO return only the value
             # FIXME: [E1101(no-member), ...] Instance of 'EtcdResult' has no 'value' member
-            return json.loads(data.value)  # pylint: disable=E1101
+            return decode_value(data.value)  # pylint: disable=E1101
         return {}
 
-    def delete(self, key):
-        """Delete something in memory"""
+    async def async_read(self, key):
+        """Read something in memory without blocking the event loop"""
         key = os.path.join(self.root_key, key)
-        self.etcd_wrapper.delete(key, recursive=True)
+        found, value = self._get_pending(key)
+        if found:
+            return value
+        data = await self.etcd_wrapper.async_read(key)
+        if data is not None:
+            return decode_value(data.value)  # pylint: disable=E1101
+        return {}
+
+    def save_many(self, values):
+        """Save several keys in memory from a dict"""
+        for key, value in values.items():
+            self.save(key, value)
+
+    def scan(self, prefix=""):
+        """Yield (key, value) of everything in memory under a prefix
+
+        The whole tree is fetched with one recursive read
+        """
+        root_key = os.path.join(self.root_key, prefix).rstrip("/")
+        with self._lock:
+            pending = {key: value for pending in (self._flushing, self._pending)
+                       for key, value in pending.items()
+                       if key == root_key or key.startswith(root_key + "/")}
+        data = self.etcd_wrapper.read(root_key, recursive=True)
+        if data is not None:
+            for node in data.leaves:
+                if node.dir or node.key in pending:
+                    continue
+                yield node.key[len(self.root_key) + 1:], decode_value(node.value)
+        for key, value in pending.items():
+            yield key[len(self.root_key) + 1:], copy.deepcopy(value)
+
+    def read_many(self, keys):
+        """Read several keys in memory and return them in a dict
+
+        Missing keys are returned with an empty dict as value, like `read`.
+        Keys in the same folder are fetched with one recursive read of this
+        folder, so everything under it is transferred. Keys without common
+        folder are read one by one.
+        """
+        keys = list(keys)
+        if len(keys) <= 1:
+            return {key: self.read(key) for key in keys}
+        prefix = os.path.commonpath(keys)
+        if not prefix:
+            return {key: self.read(key) for key in keys}
+        values = dict(self.scan(prefix))
+        return {key: values.get(key, {}) for key in keys}
+
+    def delete(self, key):
+        """Delete something in memory
+
+        A running flush is waited for, so it can not write the key back
+        """
+        key = os.path.join(self.root_key, key).rstrip("/")
+        with self._flush_lock:
+            self._drop_pending(key)
+            self.etcd_wrapper.delete(key, recursive=True)
+
+    async def async_delete(self, key):
+        """Delete something in memory without blocking the event loop"""
+        if self.flush_interval is not None:
+            # Waiting for a running flush would block the event loop
+            await asyncio.get_event_loop().run_in_executor(None, self.delete, key)
+            return
+        key = os.path.join(self.root_key, key).rstrip("/")
+        self._drop_pending(key)
+        await self.etcd_wrapper.async_delete(key, recursive=True)
+
+    def _flush_loop(self):
+        """Flush pending writes every `flush_interval` seconds"""
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Write all pending saves to etcd"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._flushing = pending
+            if not pending:
+                return
+            failed = {}
+            for key, value in pending.items():
+                if self.etcd_wrapper.write(key, value, codec=self.codec) is None:
+                    failed[key] = value
+            if failed:
+                self.logger.warning("%d memory writes failed, retrying on next flush", len(failed))
+            with self._lock:
+                self._flushing = {}
+                if failed:
+                    # Keep newer values saved during the flush
+                    failed.update(self._pending)
+                    self._pending = failed
+            self.logger.debug("%d memory writes flushed", len(pending) - len(failed))
+
+    def stop(self):
+        """Stop the background flush and write pending saves"""
+        self._stop_event.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
@@ -1,12 +1,17 @@
 """Module defining TuxEatPi Messages"""
 
-import json
-
 from tuxeatpi_common.error import TuxEatPiError
+from tuxeatpi_common.serializers import JSON_READER
 
 
 class Message():
-    """Message class"""
+    """Message class
+
+    The payload is serialized when first used and then cached, so a message
+    must not be changed once published.
+    """
+
+    __slots__ = ("topic", "data", "context", "source", "_payload")
 
     def __init__(self, topic, data, context="general", source=None):
         self.topic = topic
@@ -14,7 +19,27 @@ class Message():
         self.context = context
         self.source = source
         self._validate()
-        self.payload = self.serialize()
+        self._payload = None
+
+    @classmethod
+    def from_payload(cls, payload):
+        """Create a message from a received payload
+
+        The payload is kept as is, so forwarding the message does not
+        serialize it again
+        """
+        content = JSON_READER.decode(payload)
+        message = cls(content.get('topic'), content.get('data'),
+                      content.get('context', "general"), content.get('source'))
+        message._payload = payload
+        return message
+
+    @property
+    def payload(self):
+        """Return the serialized message"""
+        if self._payload is None:
+            self._payload = self.serialize()
+        return self._payload
 
     def _validate(self):
         """Valide message content"""
@@ -25,7 +50,7 @@ class Message():
 
     def serialize(self):
         """Serialize message content"""
-        return json.dumps({
+        return JSON_READER.encode({
             'topic': self.topic,
             'data': self.data,
             'context': self.context,
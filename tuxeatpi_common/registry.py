@@ -1,50 +1,234 @@
 """Module to handle registry in Etcd"""
-import json
 import logging
 import os
+import threading
 import time
 
+import etcd
+import urllib3
+
+from tuxeatpi_common.error import TuxEatPiError
+from tuxeatpi_common.etcd_client import WATCH_TIMEOUT
+from tuxeatpi_common.serializers import decode_value, get_codec
+
 
 class RegistryHandler(object):
-    """Registry handler class"""
+    """Registry handler class
+
+    With `ttl` (in seconds), the registry record expires in etcd if it is
+    not refreshed in time. The record is written once and the next pings
+    only refresh its TTL, so dead components disappear from the registry
+    by themselves. `ttl` must be greater than the ping interval.
+    """
 
-    def __init__(self, component_name, component_version, etcd_wrapper):
+    def __init__(self, component_name, component_version, etcd_wrapper, codec=None, ttl=None):
         self.root_key = "/registry"
         self.name = component_name
         self.version = component_version
         self.key = os.path.join(self.root_key, component_name)
         self.etcd_wrapper = etcd_wrapper
+        self.codec = None if codec is None else get_codec(codec)
+        self.ttl = ttl
+        # State of the record currently in etcd, in TTL mode
+        self._registered_state = None
         self.logger = logging.getLogger(name="tep").getChild(component_name).getChild('register')
 
-    def ping(self, state="ALIVE"):
-        """Send ping data to etcd"""
-        data = {"name": self.name,
+    def _get_ping_data(self, state):
+        """Return the registry record of the component"""
+        return {"name": self.name,
                 "version": self.version,
                 "date": time.time(),
                 "state": state}
+
+    def ping(self, state="ALIVE"):
+        """Send ping data to etcd"""
         self.logger.debug("Send ping")
-        self.etcd_wrapper.write(self.key, data)
+        if self.ttl is not None and state == self._registered_state:
+            if self.etcd_wrapper.refresh(self.key, self.ttl) is not None:
+                return
+        result = self.etcd_wrapper.write(self.key, self._get_ping_data(state),
+                                         codec=self.codec, ttl=self.ttl)
+        self._registered_state = state if result is not None else None
 
-    def read(self):
-        """Get all component states"""
-        states = {}
-        etcd_data = self.etcd_wrapper.read(self.root_key)
+    async def async_ping(self, state="ALIVE"):
+        """Send ping data to etcd without blocking the event loop"""
+        self.logger.debug("Send ping")
+        if self.ttl is not None and state == self._registered_state:
+            if await self.etcd_wrapper.async_refresh(self.key, self.ttl) is not None:
+                return
+        result = await self.etcd_wrapper.async_write(self.key, self._get_ping_data(state),
+                                                     codec=self.codec, ttl=self.ttl)
+        self._registered_state = state if result is not None else None
+
+    def _get_states(self, etcd_data):
+        """Return component states from the registry folder"""
         if etcd_data is None:
             self.logger.warning("Registry folder not found in Etcd")
             return {}
+        states = {}
         for raw_data in etcd_data.children:
-            data = json.loads(raw_data.value)
+            if raw_data.dir:
+                # Empty registry folder, when the last TTL record expired
+                continue
+            data = decode_value(raw_data.value)
             states[data['name']] = data
         return states
 
+    def read(self):
+        """Get all component states"""
+        return self._get_states(self.etcd_wrapper.read(self.root_key))
+
+    async def async_read(self):
+        """Get all component states without blocking the event loop"""
+        return self._get_states(await self.etcd_wrapper.async_read(self.root_key))
+
     def set_notalive(self, data):
         """Set component not alive in the registry"""
         self.logger.warning("Component %s set not alive", data['name'])
         data['state'] = "NOT ALIVE"
         data['date'] = time.time()
         key = os.path.join(self.root_key, data['name'])
-        self.etcd_wrapper.write(key, data)
+        self.etcd_wrapper.write(key, data, codec=self.codec)
 
     def clear(self):
         """Remove all entries in the registry"""
         self.etcd_wrapper.delete(self.root_key, recursive=True)
+
+
+class RegistryView(object):
+    """Always up to date local view of the registry
+
+    The registry folder is read once, then changes are applied from a
+    recursive watch. Callbacks are called with the component name, the
+    previous state and the new state (None when the component disappears).
+
+    The watch returns every `watch_timeout` seconds without change, so
+    `stop` does not wait for the next registry change.
+
+    `states` is replaced on each change and never modified in place, so it
+    can be iterated from any thread. Records which can not be decoded are
+    skipped.
+    """
+
+    def __init__(self, etcd_wrapper, root_key="/registry", watch_timeout=WATCH_TIMEOUT):
+        self.root_key = root_key
+        self.etcd_wrapper = etcd_wrapper
+        self.watch_timeout = watch_timeout
+        self.logger = logging.getLogger(name="tep").getChild('registry_view')
+        self.states = {}
+        self._callbacks = []
+        self._index = None
+        self._watching = False
+        self._watcher = None
+        self._lock = threading.Lock()
+
+    def add_callback(self, callback):
+        """Call `callback(name, old_state, new_state)` on each change"""
+        self._callbacks.append(callback)
+
+    def _notify(self, name, old_state, new_state):
+        """Call change callbacks"""
+        for callback in self._callbacks:
+            try:
+                callback(name, old_state, new_state)
+            except Exception:  # pylint: disable=W0703
+                self.logger.exception("Registry view callback %s failed", callback)
+
+    def _decode(self, key, value):
+        """Return the decoded registry record, or None if it is not valid"""
+        try:
+            return decode_value(value)
+        except (TypeError, ValueError, TuxEatPiError) as exp:
+            self.logger.warning("Bad registry record %s: %s, skipping it", key, exp)
+            return None
+
+    def load(self):
+        """Read the whole registry"""
+        etcd_data = self.etcd_wrapper.read(self.root_key, recursive=True)
+        if etcd_data is None:
+            # Get the current index to watch from
+            etcd_data = self.etcd_wrapper.read("/")
+            states = {}
+        else:
+            states = {}
+            for node in etcd_data.leaves:
+                if node.dir:
+                    continue
+                state = self._decode(node.key, node.value)
+                if state is not None:
+                    states[os.path.basename(node.key)] = state
+        with self._lock:
+            old_states, self.states = self.states, states
+            self._index = etcd_data.etcd_index if etcd_data is not None else None
+        for name in set(old_states).union(states):
+            if old_states.get(name) != states.get(name):
+                self._notify(name, old_states.get(name), states.get(name))
+
+    def _apply(self, event):
+        """Apply a watch event to the view"""
+        with self._lock:
+            if self._index is not None and event.modifiedIndex <= self._index:
+                return
+            self._index = event.modifiedIndex
+            if event.key.rstrip("/") == self.root_key:
+                # Whole registry changed
+                old_states, self.states = self.states, {}
+                changes = [(name, state, None) for name, state in old_states.items()]
+            elif event.dir:
+                return
+            else:
+                name = os.path.basename(event.key)
+                old_state = self.states.get(name)
+                if event.action in ("delete", "expire", "compareAndDelete"):
+                    new_state = None
+                else:
+                    new_state = self._decode(event.key, event.value)
+                    if new_state is None:
+                        return
+                # Copy on write, readers may be iterating the current states
+                states = dict(self.states)
+                if new_state is None:
+                    states.pop(name, None)
+                else:
+                    states[name] = new_state
+                self.states = states
+                changes = [(name, old_state, new_state)]
+        for change in changes:
+            self._notify(*change)
+
+    def _watch(self):
+        """Apply registry changes until stopped"""
+        while self._watching:
+            try:
+                index = None if self._index is None else self._index + 1
+                event = self.etcd_wrapper.watch(self.root_key, recursive=True, index=index,
+                                                timeout=self.watch_timeout)
+                self._apply(event)
+            except etcd.EtcdWatchTimedOut:
+                continue
+            except (etcd.EtcdException, urllib3.exceptions.HTTPError) as exp:
+                if not self._watching:
+                    break
+                self.logger.warning("Registry watch failed: %s, reloading", exp)
+                time.sleep(1)
+                try:
+                    self.load()
+                except (etcd.EtcdException, urllib3.exceptions.HTTPError):
+                    pass
+
+    def start(self):
+        """Load the registry and start watching it"""
+        self.load()
+        self._watching = True
+        self._watcher = threading.Thread(target=self._watch, daemon=True)
+        self._watcher.start()
+
+    def stop(self):
+        """Stop watching the registry
+
+        Waits up to `watch_timeout` seconds for the watch thread to exit
+        """
+        self._watching = False
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
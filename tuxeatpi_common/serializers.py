@@ -0,0 +1,110 @@
+"""Module defining codecs used to serialize values stored in etcd
+
+JSON values are stored as is, so they can be read by any component.
+Other codecs prefix values with `tep:<codec name>:`, so readers can always
+detect how a value was serialized and mixed codec components keep working.
+"""
+import base64
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+from tuxeatpi_common.error import TuxEatPiError
+
+
+CODEC_PREFIX = "tep:"
+
+
+class JsonCodec(object):
+    """Stdlib JSON codec"""
+
+    name = "json"
+
+    @staticmethod
+    def encode(value):
+        """Serialize a value"""
+        return json.dumps(value, separators=(',', ':'))
+
+    @staticmethod
+    def decode(data):
+        """Deserialize a value"""
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """JSON codec using orjson
+
+    Values are plain JSON, readable by the stdlib JSON codec
+    """
+
+    name = "orjson"
+
+    @staticmethod
+    def encode(value):
+        """Serialize a value"""
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    @staticmethod
+    def decode(data):
+        """Deserialize a value"""
+        return orjson.loads(data)
+
+
+class MsgpackCodec(object):
+    """Binary codec using msgpack
+
+    Etcd values are strings, so the msgpack data is base64 encoded
+    """
+
+    name = "msgpack"
+
+    def encode(self, value):
+        """Serialize a value"""
+        data = base64.b64encode(msgpack.packb(value, use_bin_type=True)).decode("ascii")
+        return "".join((CODEC_PREFIX, self.name, ":", data))
+
+    @staticmethod
+    def decode(data):
+        """Deserialize a value"""
+        return msgpack.unpackb(base64.b64decode(data.rsplit(":", 1)[-1]), raw=False)
+
+
+CODECS = {"json": JsonCodec,
+          "orjson": OrjsonCodec,
+          "msgpack": MsgpackCodec,
+          }
+AVAILABLE_CODECS = {"json": True,
+                    "orjson": orjson is not None,
+                    "msgpack": msgpack is not None,
+                    }
+# Fastest codec reading plain JSON values
+JSON_READER = OrjsonCodec() if orjson is not None else JsonCodec()
+
+
+def get_codec(name=None):
+    """Return a codec by name
+
+    Without name, orjson is used if available, stdlib json otherwise
+    """
+    if name is None:
+        return JSON_READER
+    if name not in CODECS:
+        raise TuxEatPiError("Codec %s not supported", name)
+    if not AVAILABLE_CODECS[name]:
+        raise TuxEatPiError("Codec %s is not installed", name)
+    return CODECS[name]()
+
+
+def decode_value(data):
+    """Deserialize a value serialized by any codec"""
+    if isinstance(data, str) and data.startswith(CODEC_PREFIX):
+        name = data[len(CODEC_PREFIX):].split(":", 1)[0]
+        return get_codec(name).decode(data)
+    return JSON_READER.decode(data)
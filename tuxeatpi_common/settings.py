@@ -1,21 +1,22 @@
 """Module defining how to handle component settings"""
 import asyncio
-import json
 import locale
 import logging
 import os
 import time
 
+from tuxeatpi_common.serializers import decode_value, get_codec
+
 
 class SettingsHandler(object):
     """Settings handler class"""
 
-    def __init__(self, component):
+    def __init__(self, component, codec=None):
         self.component = component
         self.key = os.path.join("/config", self.component.name)
         self.global_key = "/config/global"
-        # TODO use only one client !!
         self.etcd_wrapper = component.etcd_wrapper
+        self.codec = None if codec is None else get_codec(codec)
         self.logger = logging.getLogger(name="tep").getChild(component.name).getChild('settings')
         self.language = None
         self.nlu_engine = None
@@ -23,13 +24,13 @@ class SettingsHandler(object):
         self._wait_config = True
 
     def save(self, value, key=None):
-        """Serialize (json) value and save it in etcd"""
+        """Serialize value and save it in etcd"""
         if key is not None:
             key = os.path.join("/config", key)
         else:
             key = self.key
 #        self.delete(key)
-        self.etcd_wrapper.write(key, value)
+        self.etcd_wrapper.write(key, value, codec=self.codec)
 
     def delete(self, key=None):
         """Delete settings from etcd"""
@@ -54,7 +55,7 @@ class SettingsHandler(object):
                 time.sleep(3)
                 continue
             self.logger.info("Component settings received")
-            self.params = json.loads(raw_data.value)  # pylint: disable=E1101
+            self.params = decode_value(raw_data.value)  # pylint: disable=E1101
             self.component.set_config(config=self.params)
 
     def read_global(self):
@@ -67,13 +68,15 @@ class SettingsHandler(object):
                 time.sleep(3)
                 continue
             self.logger.info("Global settings received")
-            data = json.loads(raw_data.value)
+            data = decode_value(raw_data.value)
             if data.get('language') != self.language:
                 self.language = data['language']
                 self.logger.info("Language %s set", self.language)
                 # Set locale
                 encoding = locale.getlocale()[1]
                 locale.setlocale(locale.LC_ALL, (self.language, encoding))
+                # Load dialogs of the new language
+                self.component.dialogs.set_language(self.language)
                 # TODO Implement reload or not ???
                 self._reload_needed = True
                 self.logger.info("Reloading")
@@ -96,7 +99,7 @@ class SettingsHandler(object):
                 await asyncio.sleep(3)
                 continue
             self.logger.info("Component settings received")
-            self.params = json.loads(raw_data.value)  # pylint: disable=E1101
+            self.params = decode_value(raw_data.value)  # pylint: disable=E1101
             self.component.set_config(config=self.params)
             # TODO Implement reload or not ???
             # self.logger.info("Reloading")
@@ -117,13 +120,17 @@ class SettingsHandler(object):
                 await asyncio.sleep(3)
                 continue
             self.logger.info("Global settings received")
-            data = json.loads(raw_data.value)
+            data = decode_value(raw_data.value)
             if data.get('language') != self.language:
                 self.language = data['language']
                 self.logger.info("Language %s set", self.language)
                 # Set locale
                 encoding = locale.getlocale()[1]
                 locale.setlocale(locale.LC_ALL, (self.language, encoding))
+                # Load dialogs of the new language out of the event loop
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(None, self.component.dialogs.set_language,
+                                           self.language)
                 # TODO Implement reload or not ???
                 self._reload_needed = True
                 self.logger.info("Reloading")
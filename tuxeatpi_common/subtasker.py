@@ -1,31 +1,120 @@
 """Module defining Base Daemon for TuxEatPi daemons"""
 import asyncio
 import logging
+import random
 import threading
 
 
+class PeriodicTask(object):
+    """Function called every `interval` seconds on an event loop
+
+    Runs are scheduled with `loop.call_at` on absolute deadlines, so delays
+    do not accumulate. Each deadline is moved by a random offset of up to
+    `jitter` * `interval` seconds to avoid all components running their
+    tasks at the same time.
+    """
+
+    def __init__(self, interval, func, jitter=0.1, name=None):
+        self.interval = interval
+        self.func = func
+        self.jitter = jitter
+        self.name = name or getattr(func, "__name__", "periodic_task")
+        self.logger = logging.getLogger(name="tep").getChild('periodic_task')
+        self._loop = None
+        self._handle = None
+        self._deadline = None
+        self._running = None
+        # Timer accuracy
+        self.runs = 0
+        self.skipped = 0
+        self.total_lateness = 0.
+        self.max_lateness = 0.
+
+    @property
+    def mean_lateness(self):
+        """Return the mean delay between the planned and actual run times"""
+        if not self.runs:
+            return 0.
+        return self.total_lateness / self.runs
+
+    def _schedule(self):
+        """Schedule the next run"""
+        when = self._deadline + random.uniform(0, self.jitter * self.interval)
+        self._handle = self._loop.call_at(when, self._run, when)
+
+    def _run(self, planned_time):
+        """Run the function and schedule the next run"""
+        lateness = self._loop.time() - planned_time
+        self.runs += 1
+        self.total_lateness += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        self._deadline += self.interval
+        self._schedule()
+        if self._running is not None and not self._running.done():
+            self.skipped += 1
+            self.logger.warning("Previous run of %s not finished, skipping", self.name)
+            return
+        try:
+            result = self.func()
+        except Exception:  # pylint: disable=W0703
+            self.logger.exception("Periodic task %s failed", self.name)
+            return
+        if asyncio.iscoroutine(result):
+            self._running = asyncio.ensure_future(result, loop=self._loop)
+            self._running.add_done_callback(self._check_result)
+
+    def _check_result(self, future):
+        """Log errors of coroutine runs"""
+        if not future.cancelled() and future.exception() is not None:
+            self.logger.error("Periodic task %s failed: %s", self.name, future.exception())
+
+    def start(self, loop):
+        """Start running the task on an event loop"""
+        if self._handle is not None:
+            return
+        self._loop = loop
+        self._deadline = loop.time()
+        self._schedule()
+
+    def stop(self):
+        """Stop running the task"""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._running is not None:
+            self._running.cancel()
+
+
 class SubTasker(threading.Thread):
     """Base Daemon for TuxEatPi"""
 
-    def __init__(self, component):
+    def __init__(self, component, heartbeat_interval=15):
         threading.Thread.__init__(self)
         self._async_loop = None
+        # Tasks running on the component event loop, see attach
+        self._attached_tasks = None
 
         self.logger = logging.getLogger(name="tep").getChild(component.name).getChild('subtasker')
         self.component = component
+        self.periodic_tasks = []
+        self.heartbeat = self.add_periodic_task(heartbeat_interval, self._send_alive,
+                                                name="heartbeat")
 
-    @asyncio.coroutine
-    def _send_alive(self):
-        """Send alive request every 15 seconds"""
-        # TODO improve me
-        wait_count = 15
-        while True:
-            if wait_count < 15:
-                wait_count += 1
-                yield from asyncio.sleep(1)
-            else:
-                self.component.registry.ping()
-                wait_count = 0
+    async def _send_alive(self):
+        """Send alive request"""
+        await self.component.registry.async_ping()
+
+    def add_periodic_task(self, interval, func, jitter=0.1, name=None):
+        """Call `func` every `interval` seconds in the subtasker event loop
+
+        `func` can be a function or a coroutine function.
+        Returns the PeriodicTask
+        """
+        task = PeriodicTask(interval, func, jitter, name)
+        self.periodic_tasks.append(task)
+        if self._async_loop is not None:
+            self._async_loop.call_soon_threadsafe(task.start, self._async_loop)
+        return task
 
     # @asyncio.coroutine
     # def _wait_for_reload(self):
@@ -39,7 +128,42 @@ class SubTasker(threading.Thread):
         """Stop subtasker"""
         self.logger.info("Stopping subtasker for %s", self.component.name)
         if self._async_loop is not None:
-            self._async_loop.stop()
+            for task in self.periodic_tasks:
+                self._async_loop.call_soon_threadsafe(task.stop)
+            if self._attached_tasks is not None:
+                # Do not stop the component event loop
+                for task in self._attached_tasks:
+                    self._async_loop.call_soon_threadsafe(task.cancel)
+            else:
+                self._async_loop.stop()
+
+    def _get_tasks(self):
+        """Return coroutines to run until the subtasker stops"""
+        tasks = [self.component.settings.async_read(watch=True),
+                 self.component.settings.async_read_global(watch=True),
+                 # self._wait_for_reload(),
+                 ]
+        if self.component.dialogs.hot_reload:
+            tasks.append(self.component.dialogs.async_watch())
+        return tasks
+
+    def attach(self, loop):
+        """Run subtasker tasks on an existing event loop instead of a thread
+
+        Returns the scheduled asyncio tasks
+        """
+        self.logger.info("Starting subtasker for %s on the component event loop",
+                         self.component.name)
+        self._async_loop = loop
+        for task in self.periodic_tasks:
+            task.start(loop)
+        self._attached_tasks = [loop.create_task(task) for task in self._get_tasks()]
+        return self._attached_tasks
+
+    @staticmethod
+    async def _gather(tasks):
+        """Run tasks until they are all done"""
+        return await asyncio.gather(*tasks, return_exceptions=True)
 
     def run(self):
         """Startup function for main loop"""
@@ -51,18 +175,16 @@ class SubTasker(threading.Thread):
             asyncio.set_event_loop(self._async_loop)
 
         self.logger.info("Starting subtasker for %s", self.component.name)
-        tasks = [self._send_alive(),
-                 self.component.settings.async_read(watch=True),
-                 self.component.settings.async_read_global(watch=True),
-                 # self._wait_for_reload(),
-                 ]
+        for task in self.periodic_tasks:
+            self._async_loop.call_soon_threadsafe(task.start, self._async_loop)
+        tasks = self._get_tasks()
         try:
             if self._async_loop.is_running():
-                future = asyncio.run_coroutine_threadsafe(asyncio.wait(tasks),
+                future = asyncio.run_coroutine_threadsafe(self._gather(tasks),
                                                           self._async_loop)
                 future.result()
             else:
-                self._async_loop.run_until_complete(asyncio.wait(tasks))
+                self._async_loop.run_until_complete(self._gather(tasks))
         except RuntimeError:
             # Do we have to do something ?
             pass
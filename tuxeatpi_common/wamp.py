@@ -1,21 +1,273 @@
 """Module defining TuxEatPi Messages"""
 
-import json
+import asyncio
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import logging
 import os
+import threading
 import time
 
+from wampy.messages.subscribe import Subscribe
 from wampy.peers.clients import Client
 import wampy
 
 from tuxeatpi_common.error import TuxEatPiError
 from tuxeatpi_common.message import Message
+from tuxeatpi_common.serializers import JSON_READER
+
+
+class TopicDispatcher(object):
+    """Run topic handlers in a thread pool
+
+    Handlers of a serial topic run one at a time, in message order.
+    Handlers of a concurrent topic can run in parallel.
+    At most `queue_size` handlers can be waiting or running; when full,
+    `submit` blocks, which slows down the message reception.
+    """
+
+    def __init__(self, workers, queue_size=100, logger=None):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(queue_size)
+        # Serial topic -> waiting handlers, only for topics with a running handler
+        self._serial_queues = {}
+        self._lock = threading.Lock()
+        self.logger = logger or logging.getLogger(name="tep").getChild('dispatcher')
+
+    def submit(self, topic, func, serial=True):
+        """Run `func` in the thread pool"""
+        self._slots.acquire()
+        if serial:
+            with self._lock:
+                if topic in self._serial_queues:
+                    # An handler of this topic is running
+                    self._serial_queues[topic].append(func)
+                    return
+                self._serial_queues[topic] = deque()
+        self._executor.submit(self._run, topic, func, serial)
+
+    def _run(self, topic, func, serial):
+        """Run an handler, then the next waiting ones of a serial topic"""
+        while func is not None:
+            try:
+                func()
+            except Exception:  # pylint: disable=W0703
+                self.logger.exception("Error in handler of topic %s", topic)
+            finally:
+                self._slots.release()
+            func = None
+            if serial:
+                with self._lock:
+                    if self._serial_queues[topic]:
+                        func = self._serial_queues[topic].popleft()
+                    else:
+                        del self._serial_queues[topic]
+
+    def shutdown(self, wait=True):
+        """Stop the thread pool"""
+        self._executor.shutdown(wait=wait)
+
+
+class MessageBatcher(object):
+    """Group messages published on the same topic in a short time window
+
+    Messages of a topic are sent together, in one WAMP message, at most
+    `max_delay` seconds after the first one or as soon as there are
+    `max_size` of them. Coalesced messages replace the messages waiting on
+    their topic, so only the last one is sent.
+
+    Several messages are sent in a batch envelope understood by
+    `WampClient.on_message`: ``{"topic": <topic>, "batch": [<payload>, ...]}``.
+    A single message is sent as is.
+    """
+
+    def __init__(self, send, max_delay=0.05, max_size=50, logger=None):
+        self._send = send
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self.logger = logger or logging.getLogger(name="tep").getChild('batcher')
+        # Waiting messages: topic -> (deadline, [payloads])
+        self._pending = {}
+        self._cond = threading.Condition()
+        # Keep batches of a topic in order
+        self._send_lock = threading.Lock()
+        self._thread = None
+        self._must_run = True
+
+    def add(self, topic, payload, coalesce=False):
+        """Add a message payload to send on a topic
+
+        Once the batcher is stopped, messages are sent right away
+        """
+        with self._send_lock:
+            with self._cond:
+                if self._must_run:
+                    payloads = self._add_pending(topic, payload, coalesce)
+                else:
+                    payloads = [payload]
+            if payloads is not None:
+                self._publish(topic, payloads)
+
+    def _add_pending(self, topic, payload, coalesce):
+        """Add a message to the waiting ones
+
+        Must be called with the condition held.
+        Returns the payloads to send now if the batch is full, None otherwise
+        """
+        if topic not in self._pending:
+            self._pending[topic] = (time.monotonic() + self.max_delay, [])
+            self._cond.notify()
+        payloads = self._pending[topic][1]
+        if coalesce:
+            payloads.clear()
+        payloads.append(payload)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        if len(payloads) < self.max_size:
+            return None
+        del self._pending[topic]
+        return payloads
+
+    def _run(self):
+        """Send batches when their delay expires"""
+        while True:
+            with self._cond:
+                if not self._must_run:
+                    return
+                if not self._pending:
+                    self._cond.wait()
+                    continue
+                timeout = min(deadline for deadline, _ in self._pending.values())
+                timeout -= time.monotonic()
+                if timeout > 0:
+                    self._cond.wait(timeout)
+                    continue
+            self.flush(due_only=True)
+
+    def flush(self, due_only=False):
+        """Send waiting messages
+
+        With `due_only`, only batches whose delay expired are sent
+        """
+        with self._send_lock:
+            with self._cond:
+                now = time.monotonic()
+                topics = [topic for topic, (deadline, _) in self._pending.items()
+                          if not due_only or deadline <= now]
+                batches = [(topic, self._pending.pop(topic)[1]) for topic in topics]
+            for topic, payloads in batches:
+                self._publish(topic, payloads)
+
+    def _publish(self, topic, payloads):
+        """Send a batch"""
+        if len(payloads) == 1:
+            payload = payloads[0]
+        else:
+            # Payloads are already JSON, do not serialize them again
+            payload = '{"topic":%s,"batch":[%s]}' % (JSON_READER.encode(topic),
+                                                     ",".join(payloads))
+        try:
+            self._send(topic, payload)
+        except Exception:  # pylint: disable=W0703
+            self.logger.exception("Can not publish %d messages on %s", len(payloads), topic)
+
+    def stop(self):
+        """Stop the batcher and send waiting messages
+
+        Messages added later are not batched anymore
+        """
+        with self._cond:
+            self._must_run = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+
+class _TopicNode(object):
+    """Node of a topic trie"""
+
+    __slots__ = ("children", "value", "prefix_value")
+
+    def __init__(self):
+        self.children = {}
+        self.value = None
+        self.prefix_value = None
+
+
+class TopicTrie(object):
+    """Topic patterns indexed by topic parts
+
+    `wildcard` patterns match topics with the same number of parts, an
+    empty part matching any part: `tuxeatpi..status` matches
+    `tuxeatpi.nlu.status`. `prefix` patterns match the topic and all its sub
+    topics: `tuxeatpi.nlu` matches `tuxeatpi.nlu.text`. Prefixes match at
+    topic part boundaries only.
+
+    `match` returns the most specific pattern value: literal parts win over
+    wildcard parts, and wildcard patterns over prefix patterns.
+    """
+
+    def __init__(self):
+        self._root = _TopicNode()
+
+    def add(self, pattern, value, match="wildcard"):
+        """Add a topic pattern"""
+        node = self._root
+        for part in pattern.split("."):
+            node = node.children.setdefault(part, _TopicNode())
+        if match == "prefix":
+            node.prefix_value = value
+        else:
+            node.value = value
+
+    def match(self, topic):
+        """Return the value of the most specific pattern matching a topic, or None"""
+        parts = topic.split(".")
+        value = self._match(self._root, parts, 0)
+        if value is not None:
+            return value
+        # Deepest prefix
+        node = self._root
+        for part in parts:
+            node = node.children.get(part)
+            if node is None:
+                break
+            if node.prefix_value is not None:
+                value = node.prefix_value
+        return value
+
+    def _match(self, node, parts, index):
+        """Return the value of the wildcard pattern matching topic parts from index"""
+        if index == len(parts):
+            return node.value
+        for part in (parts[index], ""):
+            child = node.children.get(part)
+            if child is not None:
+                value = self._match(child, parts, index + 1)
+                if value is not None:
+                    return value
+        return None
 
 
 class WampClient(Client):
-    """Wamp client class"""
+    """Wamp client class
+
+    With `workers` (or `TEP_WAMP_WORKERS`) greater than 0, topic handlers
+    run in a pool of `workers` threads instead of on the message reception
+    path, with up to `queue_size` waiting handlers.
+
+    Messages published with `batch` or `coalesce` go through a
+    MessageBatcher using `batch_delay` and `batch_size`.
 
-    def __init__(self, component):
+    Topic and RPC handlers can be coroutine functions; they are scheduled
+    on the component event loop, so several of them can run at the same
+    time. Calls and durations of each handler are kept in `handler_stats`.
+    """
+
+    def __init__(self, component, workers=None, queue_size=100, batch_delay=0.05,
+                 batch_size=50):
         self.host = os.environ.get("TEP_WAMP_HOST", "127.0.0.1")
         self.port = int(os.environ.get("TEP_WAMP_PORT", 8080))
         Client.__init__(self, realm="tuxeatpi", url="ws://{}:{}".format(self.host, self.port))
@@ -24,63 +276,208 @@ class WampClient(Client):
         self._must_run = True
         self.topics = {}
         self.rpc_funcs = {}
+        # Routing table: topic -> (method, serial, is_coroutine), see _get_topics
+        self._routes = {}
+        self._patterns = TopicTrie()
         self._get_topics()
+        if workers is None:
+            workers = int(os.environ.get("TEP_WAMP_WORKERS", 0))
+        self.dispatcher = None
+        if workers > 0:
+            self.dispatcher = TopicDispatcher(workers, queue_size, self.logger)
+        # Handler name -> {"calls", "total_time", "max_time"}
+        self.handler_stats = {}
+        self._stats_lock = threading.Lock()
+        # (event loop, handler name) -> semaphore
+        self._semaphores = {}
+        self.batch_delay = batch_delay
+        self.batch_size = batch_size
+        self.batcher = None
 
     def _get_topics(self):
         """Get topics list from decorator"""
-        for attr in dir(self.component):
-            if callable(getattr(self.component, attr)):
-                method = getattr(self.component, attr)
-                # Subscribing to a topic
-                if hasattr(method, "_topic_name"):
-                    if getattr(method, "_is_root"):
-                        topic_name = method._topic_name
-                    else:
-                        topic_name = ".".join((self.component.name,
-                                               method._topic_name))
-                    self.topics[topic_name] = method
-                # Register RPC function
-                if hasattr(method, "_rpc_name"):
-                    if getattr(method, "_is_root"):
-                        rpc_name = method._rpc_name
-                    else:
-                        rpc_name = ".".join((self.component.name,
-                                             method._rpc_name))
-                    self.rpc_funcs[rpc_name] = method
+        for attr in get_wamp_methods(type(self.component)):
+            method = getattr(self.component, attr)
+            # Subscribing to a topic
+            if hasattr(method, "_topic_name"):
+                if getattr(method, "_is_root"):
+                    topic_name = method._topic_name
+                else:
+                    topic_name = ".".join((self.component.name,
+                                           method._topic_name))
+                self.topics[topic_name] = method
+                route = (method, not getattr(method, "_is_concurrent", False),
+                         asyncio.iscoroutinefunction(method))
+                self._routes[topic_name] = route
+                if getattr(method, "_match", None) is not None:
+                    self._patterns.add(topic_name, route, method._match)
+            # Register RPC function
+            if hasattr(method, "_rpc_name"):
+                if getattr(method, "_is_root"):
+                    rpc_name = method._rpc_name
+                else:
+                    rpc_name = ".".join((self.component.name,
+                                         method._rpc_name))
+                self.rpc_funcs[rpc_name] = method
         self.logger.debug(self.topics)
 
+    def get_route(self, topic):
+        """Return (method, serial, is_coroutine) handling a topic, or None
+
+        Subscribed topics are found with one lookup in the routing table,
+        other topics are matched against `prefix` and `wildcard` topics.
+        """
+        route = self._routes.get(topic)
+        if route is None:
+            route = self._patterns.match(topic)
+        return route
+
     def on_message(self, message, meta):  # pylint: disable=W0221,W0613
         """Callback on receive message"""
         self.logger.debug("topic: %s - subscription_id: %s - message: %s",
                           meta['topic'], meta['subscription_id'], message)
-        class_name, _ = meta['topic'].split(".")
-        if self.component.name.lower() != class_name.lower() and class_name != "global":
-            self.logger.error("Bad destination")
-        elif meta['topic'] not in self.topics:
+        # Wampy gives the subscribed topic, which is in the routing table
+        route = self.get_route(meta['topic'])
+        if route is None:
             self.logger.error("Bad destination function %s", meta['topic'])
+            return
+        payload = JSON_READER.decode(message)
+        for item in payload.get("batch", (payload,)):
+            self._dispatch(route, item.get("data", {}).get('arguments', {}), message, meta)
+
+    def _dispatch(self, route, arguments, message, meta):
+        """Call topic method inline or in the thread pool"""
+        method, serial, is_coroutine = route
+        if self.dispatcher is None:
+            self._call_topic(method, arguments, message, meta, is_coroutine)
         else:
-            payload = json.loads(message)
-            data = payload.get("data", {})
-            # Call method
-            try:
-                self.topics[meta['topic']](**data.get('arguments', {}))
-            except TypeError as exp:
-                self.logger.critical("Error on topic event: %s - subscription_id: %s"
-                                     " - message: %s",
-                                     meta['topic'], meta['subscription_id'], message)
-                self.logger.critical("Error: %s", exp)
-
-    def publish(self, message, override_topic=None):  # pylint: disable=W0221
-        """Publish message to WAMP"""
+            self.dispatcher.submit(meta['topic'],
+                                   lambda: self._call_topic(method, arguments, message, meta,
+                                                            is_coroutine),
+                                   serial=serial)
+
+    def _call_topic(self, method, arguments, message, meta, is_coroutine=None):
+        """Call topic method"""
+        if is_coroutine is None:
+            is_coroutine = asyncio.iscoroutinefunction(method)
+        if is_coroutine:
+            future = self._run_coroutine(method, (), arguments)
+            future.add_done_callback(
+                lambda future: self._check_topic_result(future, message, meta))
+            return
+        start_time = time.time()
+        try:
+            method(**arguments)
+        except TypeError as exp:
+            self._log_topic_error(exp, message, meta)
+        finally:
+            self._record_timing(method, time.time() - start_time)
+
+    def _check_topic_result(self, future, message, meta):
+        """Log errors of coroutine topic methods"""
+        if not future.cancelled() and future.exception() is not None:
+            self._log_topic_error(future.exception(), message, meta)
+
+    def _log_topic_error(self, exp, message, meta):
+        """Log topic method error"""
+        self.logger.critical("Error on topic event: %s - subscription_id: %s"
+                             " - message: %s",
+                             meta['topic'], meta['subscription_id'], message)
+        self.logger.critical("Error: %s", exp)
+
+    def _record_timing(self, method, duration):
+        """Save handler call duration"""
+        # Handlers can run in the dispatcher threads
+        with self._stats_lock:
+            stats = self.handler_stats.setdefault(method.__name__, {"calls": 0,
+                                                                    "total_time": 0.,
+                                                                    "max_time": 0.})
+            stats["calls"] += 1
+            stats["total_time"] += duration
+            stats["max_time"] = max(stats["max_time"], duration)
+
+    async def _run_handler(self, method, args, kwargs):
+        """Run a coroutine handler within its concurrency limit
+
+        Semaphores are bound to the event loop creating them, so there is
+        one per loop and handler
+        """
+        max_concurrency = getattr(method, "_max_concurrency", None)
+        semaphore_key = (asyncio.get_event_loop(), method.__name__)
+        if max_concurrency is not None and semaphore_key not in self._semaphores:
+            self._semaphores[semaphore_key] = asyncio.Semaphore(max_concurrency)
+        semaphore = self._semaphores.get(semaphore_key)
+        if semaphore is None:
+            return await self._timed_call(method, args, kwargs)
+        async with semaphore:
+            return await self._timed_call(method, args, kwargs)
+
+    async def _timed_call(self, method, args, kwargs):
+        """Run a coroutine handler and save its duration"""
+        start_time = time.time()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            self._record_timing(method, time.time() - start_time)
+
+    def _run_coroutine(self, method, args, kwargs):
+        """Schedule a coroutine handler on the component event loop
+
+        Returns a concurrent Future
+        """
+        loop = self.component.get_running_loop()
+        if loop is not None:
+            return asyncio.run_coroutine_threadsafe(self._run_handler(method, args, kwargs),
+                                                    loop)
+        # No running event loop yet, run it here
+        future = Future()
+        loop = asyncio.new_event_loop()
+        try:
+            future.set_result(loop.run_until_complete(self._run_handler(method, args, kwargs)))
+        except Exception as exp:  # pylint: disable=W0703
+            future.set_exception(exp)
+        finally:
+            loop.close()
+            for semaphore_key in list(self._semaphores):
+                if semaphore_key[0] is loop:
+                    self._semaphores.pop(semaphore_key, None)
+        return future
+
+    def _wrap_async_rpc(self, method):
+        """Return a blocking function calling a coroutine RPC method"""
+        def rpc_func(*args, **kwargs):
+            """Run the coroutine on the component event loop and wait for the result"""
+            return self._run_coroutine(method, args, kwargs).result()
+        return rpc_func
+
+    def publish(self, message, override_topic=None, batch=False,  # pylint: disable=W0221
+                coalesce=False):
+        """Publish message to WAMP
+
+        With `batch`, the message is sent with the other messages published
+        on the same topic in the next `batch_delay` seconds.
+        With `coalesce`, it is only sent if no other message is published on
+        the same topic in the next `batch_delay` seconds.
+        """
         if not isinstance(message, Message):
             raise TuxEatPiError("message must be a Message object")
         if override_topic is None:
             topic = message.topic
         else:
             topic = override_topic
+        if not batch and not coalesce:
+            self._send(topic, message.payload)
+            return
+        if self.batcher is None:
+            self.batcher = MessageBatcher(self._send, self.batch_delay, self.batch_size,
+                                          self.logger.getChild('batcher'))
+        self.batcher.add(topic, message.payload, coalesce)
+
+    def _send(self, topic, payload):
+        """Send a payload to WAMP"""
         super(WampClient, self).publish(topic=topic,
                                         options={"exclude_me": False},
-                                        message=message.payload)
+                                        message=payload)
 
     def call(self, endpoint, *args, **kwargs):  # pylint: disable=W0221
         """Call RPC function
@@ -113,42 +510,107 @@ class WampClient(Client):
         # Subscribing topics
         for topic_name, method in self.topics.items():
             # subscriber = subscribe(topic=topic_name)
-            self.session._subscribe_to_topic(self.on_message, topic_name)
+            match = getattr(method, "_match", None)
+            if match is None:
+                self.session._subscribe_to_topic(self.on_message, topic_name)
+            else:
+                self._subscribe_to_pattern(topic_name, match)
             self.logger.info("Subcribe to topic %s", topic_name)
         # Registering RPCs
         for rpc_name, method in self.rpc_funcs.items():
             self.session._register_procedure(rpc_name)
             if hasattr(self, rpc_name):
                 raise Exception("method already exexits: %s", rpc_name)
-            setattr(self, rpc_name, method)
+            if asyncio.iscoroutinefunction(method):
+                setattr(self, rpc_name, self._wrap_async_rpc(method))
+            else:
+                setattr(self, rpc_name, method)
             self.logger.info("RPC %s registereds", rpc_name)
         # Registering RPCs
 
+    def _subscribe_to_pattern(self, topic_name, match):
+        """Subscribe to a prefix or wildcard topic
+
+        Wampy does not handle subscription options, so the SUBSCRIBE
+        message is sent here
+        """
+        message = Subscribe(topic=topic_name, options={"match": match})
+        self.session.send_message(message)
+        self.session.request_ids[message.request_id] = message, self.on_message
+
     def stop(self):
         """Stop WAMP client"""
+        if self.batcher is not None:
+            self.batcher.stop()
         try:
             super(WampClient, self).stop()
         except AssertionError:
             pass
+        if self.dispatcher is not None:
+            self.dispatcher.shutdown(wait=False)
+
 
+def get_wamp_methods(cls):
+    """Return names of the methods of a class decorated by is_wamp_topic or is_wamp_rpc
+
+    Methods are looked up in the class dicts, so properties and other
+    attributes are never evaluated. The result is computed once and cached
+    in the class; methods added to the class later are not seen.
+    """
+    methods = cls.__dict__.get("_wamp_methods")
+    if methods is None:
+        found = {}
+        for klass in reversed(cls.__mro__):
+            for attr, value in vars(klass).items():
+                # Handle staticmethod and classmethod
+                func = getattr(value, "__func__", value)
+                if hasattr(func, "_topic_name") or hasattr(func, "_rpc_name"):
+                    found[attr] = None
+                else:
+                    # Overridden without decorator
+                    found.pop(attr, None)
+        methods = tuple(found)
+        setattr(cls, "_wamp_methods", methods)
+    return methods
+
+
+def is_wamp_topic(topic_name, root=False, concurrent=False, max_concurrency=None,
+                  match=None):
+    """Add a method as a WAMP topic
+
+    With `concurrent`, several messages of this topic can be handled at
+    the same time when the WAMP client uses a thread pool.
+    For coroutine methods, `max_concurrency` limits how many calls can run
+    at the same time.
+    With `match` set to `prefix` or `wildcard`, the method receives
+    messages of all topics matching `topic_name`, see TopicTrie.
+    """
+    if match not in (None, "prefix", "wildcard"):
+        raise TuxEatPiError("Bad topic match %s", match)
 
-def is_wamp_topic(topic_name, root=False):
-    """Add a method as a WAMP topic"""
     def wrapper(func):
         """Wrapper for is_wamp_topic decorator"""
         func._topic_name = topic_name
         func._is_root = root
+        func._is_concurrent = concurrent
+        func._max_concurrency = max_concurrency
+        func._match = match
         return func
 
     return wrapper
 
 
-def is_wamp_rpc(rpc_name, root=False):
-    """Add a method as a WAMP RPC funcs"""
+def is_wamp_rpc(rpc_name, root=False, max_concurrency=None):
+    """Add a method as a WAMP RPC funcs
+
+    For coroutine methods, `max_concurrency` limits how many calls can run
+    at the same time.
+    """
     def wrapper(func):
         """Wrapper for is_wamp_rpc decorator"""
         func._rpc_name = rpc_name
         func._is_root = root
+        func._max_concurrency = max_concurrency
         return func
 
     return wrapper